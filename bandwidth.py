@@ -0,0 +1,89 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+DOWNLOAD_RATE_LIMIT_MB = float(os.getenv('DOWNLOAD_RATE_LIMIT_MB', '0'))
+JOB_RATE_LIMIT_MB = float(os.getenv('JOB_RATE_LIMIT_MB', '0'))
+BANDWIDTH_BURST_SECONDS = float(os.getenv('BANDWIDTH_BURST_SECONDS', '1'))
+
+
+class DownloadShare:
+    def __init__(self):
+        self.rate: Optional[float] = None
+        self.downloaded: Dict[str, int] = {}
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def throttle(self, filename: Optional[str], downloaded_bytes: Optional[int]) -> float:
+        if downloaded_bytes is None:
+            return 0.0
+        with self.lock:
+            delta = max(0, downloaded_bytes - self.downloaded.get(filename, downloaded_bytes))
+            self.downloaded[filename] = max(self.downloaded.get(filename, 0), downloaded_bytes)
+            rate = self.rate
+            if not rate or not delta:
+                return 0.0
+            now = time.monotonic()
+            start = max(self.next_time, now - BANDWIDTH_BURST_SECONDS)
+            self.next_time = start + delta / rate
+            delay = self.next_time - now
+        if delay > 0:
+            throttled_seconds.inc(delay)
+            return delay
+        return 0.0
+
+
+class BandwidthGovernor:
+    def __init__(self, rate_mb: float = DOWNLOAD_RATE_LIMIT_MB, job_rate_mb: float = JOB_RATE_LIMIT_MB):
+        self.rate = rate_mb * MB if rate_mb > 0 else None
+        self.job_rate = job_rate_mb * MB if job_rate_mb > 0 else None
+        self.shares: Dict[int, DownloadShare] = {}
+        self.lock = threading.Lock()
+
+    def _share_rate(self) -> Optional[float]:
+        rates = [self.job_rate] if self.job_rate else []
+        if self.rate:
+            rates.append(self.rate / max(1, len(self.shares)))
+        return min(rates) if rates else None
+
+    def _rebalance(self):
+        rate = self._share_rate()
+        for share in self.shares.values():
+            share.rate = rate
+        if rate and self.shares:
+            logger.info(f"Полоса загрузки: {len(self.shares)} активных загрузок по {rate / MB:.2f} МБ/с")
+
+    @contextmanager
+    def share(self):
+        share = DownloadShare()
+        with self.lock:
+            self.shares[id(share)] = share
+            self._rebalance()
+        try:
+            yield share
+        finally:
+            with self.lock:
+                self.shares.pop(id(share), None)
+                self._rebalance()
+
+    @property
+    def active(self) -> int:
+        return len(self.shares)
+
+
+governor = BandwidthGovernor()
+
+throttled_seconds = metrics.registry.counter('syntube_bandwidth_throttled_seconds_total',
+                                             'Суммарные паузы загрузок из-за ограничения полосы')
+
+metrics.registry.gauge('syntube_bandwidth_active_downloads', 'Загрузки, делящие общую полосу',
+                       lambda: governor.active)
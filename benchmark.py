@@ -0,0 +1,418 @@
+import argparse
+import asyncio
+import copy
+import json
+import logging
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import db
+import storage
+import video_processor
+from video_processor import VideoProcessor
+
+logger = logging.getLogger(__name__)
+
+BENCH_USER_ID = 100500
+
+
+def run_ffmpeg(*args: str):
+    cmd = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-y', *args]
+    subprocess.run(cmd, check=True)
+
+
+def make_synthetic_media(path: Path, duration: int, is_video: bool) -> Path:
+    if path.exists():
+        return path
+    if is_video:
+        run_ffmpeg(
+            '-f', 'lavfi', '-i', f'testsrc2=size=640x360:rate=25:duration={duration}',
+            '-f', 'lavfi', '-i', f'sine=frequency=440:sample_rate=44100:duration={duration}',
+            '-c:v', 'libx264', '-preset', 'ultrafast', '-g', '50',
+            '-c:a', 'aac', '-b:a', '128k', '-shortest', str(path)
+        )
+    else:
+        run_ffmpeg(
+            '-f', 'lavfi', '-i', f'sine=frequency=440:sample_rate=44100:duration={duration}',
+            '-c:a', 'libmp3lame', '-b:a', '192k', str(path)
+        )
+    return path
+
+
+def make_synthetic_thumbnail(path: Path, width: int = 1280, height: int = 720) -> Path:
+    if not path.exists():
+        run_ffmpeg('-f', 'lavfi', '-i', f'testsrc=size={width}x{height}', '-frames:v', '1', str(path))
+    return path
+
+
+def make_chapters(duration: int, count: int) -> List[Dict[str, Any]]:
+    step = duration / count
+    return [
+        {'start_time': float(int(i * step)), 'end_time': float(int((i + 1) * step)), 'title': f'{i + 1:02d}. Track {i + 1}'}
+        for i in range(count)
+    ]
+
+
+def make_timestamps_text(duration: int, count: int) -> str:
+    step = duration // count
+    lines = []
+    for i in range(count):
+        seconds = i * step
+        lines.append(f"{seconds // 3600}:{(seconds % 3600) // 60:02d}:{seconds % 60:02d} Track number {i + 1}")
+    return "Tracklist:\n" + "\n".join(lines)
+
+
+def make_info(video_id: str, duration: int, chapters: int) -> Dict[str, Any]:
+    return {
+        'id': video_id,
+        'title': f'Synthetic {duration}s x{chapters}',
+        'duration': duration,
+        'chapters': make_chapters(duration, chapters) if chapters > 1 else None,
+        'description': make_timestamps_text(duration, chapters) if chapters > 1 else '',
+        'thumbnails': [],
+        'comments': [],
+        'webpage_url': f'https://bench.invalid/watch?v={video_id}',
+        'extractor': 'generic',
+    }
+
+
+class FakeYoutubeDL:
+    infos: Dict[str, Dict[str, Any]] = {}
+    sources: Dict[str, Dict[bool, Path]] = {}
+
+    def __init__(self, params: Optional[Dict[str, Any]] = None):
+        self.params = params or {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def extract_info(self, url: str, download: bool = True, **kwargs) -> Dict[str, Any]:
+        return copy.deepcopy(self.infos[url])
+
+    @staticmethod
+    def sanitize_info(info: Dict[str, Any]) -> Dict[str, Any]:
+        return info
+
+    def download(self, urls: List[str]) -> int:
+        for url in urls:
+            postprocessors = self.params.get('postprocessors') or []
+            is_audio = any(pp.get('key') == 'FFmpegExtractAudio' for pp in postprocessors)
+            source = self.sources[url][not is_audio]
+            outtmpl = self.params['outtmpl']
+            if isinstance(outtmpl, dict):
+                outtmpl = outtmpl['default']
+            target = Path(outtmpl.replace('%(ext)s', source.suffix.lstrip('.')))
+            shutil.copyfile(source, target)
+            for hook in self.params.get('progress_hooks', []):
+                hook({'status': 'downloading', '_percent_str': '100.0%',
+                      'downloaded_bytes': target.stat().st_size, 'total_bytes': target.stat().st_size})
+                hook({'status': 'finished', 'filename': str(target)})
+        return 0
+
+
+def install_fake_yt_dlp():
+    video_processor.yt_dlp = SimpleNamespace(YoutubeDL=FakeYoutubeDL)
+
+
+class FakeBot:
+    def __init__(self, upload_latency: float = 0.0):
+        self.upload_latency = upload_latency
+        self.calls: Dict[str, int] = {}
+        self.uploaded_bytes = 0
+        self._message_id = 0
+
+    def _record(self, method: str):
+        self.calls[method] = self.calls.get(method, 0) + 1
+        self._message_id += 1
+        return SimpleNamespace(message_id=self._message_id)
+
+    async def _consume(self, file_obj):
+        if file_obj is not None:
+            content = getattr(file_obj, 'input_file_content', file_obj)
+            self.uploaded_bytes += len(content if isinstance(content, bytes) else content.read())
+        if self.upload_latency:
+            await asyncio.sleep(self.upload_latency)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        return self._record('send_message')
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        return self._record('edit_message_text')
+
+    async def pin_chat_message(self, chat_id, message_id, **kwargs):
+        return self._record('pin_chat_message')
+
+    async def delete_message(self, chat_id, message_id, **kwargs):
+        return self._record('delete_message')
+
+    async def send_audio(self, chat_id, audio, **kwargs):
+        await self._consume(audio)
+        return self._record('send_audio')
+
+    async def send_video(self, chat_id, video, **kwargs):
+        await self._consume(video)
+        return self._record('send_video')
+
+
+def summarize(name: str, params: Dict[str, Any], samples: List[float], extra: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    result = {
+        'name': name,
+        'params': params,
+        'runs': len(samples),
+        'min_s': min(samples),
+        'median_s': statistics.median(samples),
+        'mean_s': statistics.fmean(samples),
+        'max_s': max(samples),
+        'stdev_s': statistics.stdev(samples) if len(samples) > 1 else 0.0,
+    }
+    if extra:
+        result.update(extra)
+    logger.info(f"{name} {params}: median {result['median_s']:.4f}s ({len(samples)} прогонов)")
+    return result
+
+
+async def measure(repeat: int, setup: Callable[[], Awaitable[Any]], run: Callable[[Any], Awaitable[Any]],
+                  teardown: Callable[[Any], Awaitable[Any]]) -> List[float]:
+    samples = []
+    for _ in range(repeat):
+        ctx = await setup()
+        try:
+            started = time.perf_counter()
+            await run(ctx)
+            samples.append(time.perf_counter() - started)
+        finally:
+            await teardown(ctx)
+    return samples
+
+
+class Benchmark:
+    def __init__(self, work_dir: Path, durations: List[int], chapters: List[int], repeat: int,
+                 include_full_flow: bool = True, upload_pause: float = 0.0):
+        self.work_dir = work_dir
+        self.media_dir = work_dir / 'media'
+        self.media_dir.mkdir(parents=True, exist_ok=True)
+        self.durations = durations
+        self.chapters = chapters
+        self.repeat = repeat
+        self.include_full_flow = include_full_flow
+        self.upload_pause = upload_pause
+        self.results: List[Dict[str, Any]] = []
+
+    def source(self, duration: int, is_video: bool) -> Path:
+        ext = 'mp4' if is_video else 'mp3'
+        return make_synthetic_media(self.media_dir / f'source_{duration}.{ext}', duration, is_video)
+
+    def register(self, video_id: str, duration: int, chapters: int) -> str:
+        info = make_info(video_id, duration, chapters)
+        url = info['webpage_url']
+        FakeYoutubeDL.infos[url] = info
+        FakeYoutubeDL.sources[url] = {True: self.source(duration, True), False: self.source(duration, False)}
+        return url
+
+    def new_processor(self, info: Optional[Dict[str, Any]] = None) -> VideoProcessor:
+        processor = VideoProcessor(temp_dir=str(self.work_dir / f'job_{time.perf_counter_ns()}'))
+        processor.temp_dir.mkdir(parents=True, exist_ok=True)
+        processor.video_info = copy.deepcopy(info) if info else None
+        return processor
+
+    async def bench_parse_timestamps(self):
+        processor = self.new_processor()
+        for count in self.chapters:
+            text = make_timestamps_text(max(self.durations), count)
+            iterations = 200
+
+            async def run(_):
+                for _ in range(iterations):
+                    processor.parse_timestamps(text)
+
+            samples = await measure(self.repeat, _noop, run, _noop)
+            self.results.append(summarize('parse_timestamps', {'chapters': count, 'iterations': iterations}, samples))
+        await processor.cleanup()
+
+    async def bench_process_thumbnail(self):
+        source = make_synthetic_thumbnail(self.media_dir / 'thumbnail.png')
+
+        async def setup():
+            processor = self.new_processor()
+            target = processor.temp_dir / 'thumbnail.png'
+            shutil.copyfile(source, target)
+            return processor, target
+
+        async def run(ctx):
+            processor, target = ctx
+            processor._process_thumbnail(target)
+
+        samples = await measure(self.repeat, setup, run, lambda ctx: ctx[0].cleanup())
+        self.results.append(summarize('_process_thumbnail', {'size': '1280x720'}, samples))
+
+    async def bench_add_metadata(self):
+        thumbnail = make_synthetic_thumbnail(self.media_dir / 'thumbnail.png')
+        for duration in self.durations:
+            source = self.source(duration, False)
+
+            async def setup():
+                processor = self.new_processor()
+                target = processor.temp_dir / source.name
+                shutil.copyfile(source, target)
+                processor.thumbnail_path = processor._process_thumbnail(shutil.copyfile(thumbnail, processor.temp_dir / thumbnail.name))
+                return processor, target
+
+            async def run(ctx):
+                processor, target = ctx
+                await processor.add_metadata_to_audio(target, title='Track', artist='Artist')
+
+            samples = await measure(self.repeat, setup, run, lambda ctx: ctx[0].cleanup())
+            self.results.append(summarize('add_metadata_to_audio', {'duration': duration}, samples))
+
+    async def bench_split_media(self):
+        for duration in self.durations:
+            for count in self.chapters:
+                if count < 2:
+                    continue
+                for is_video in (False, True):
+                    info = make_info('split', duration, count)
+                    source = self.source(duration, is_video)
+                    timestamps = [(int(c['start_time']), c['title']) for c in info['chapters']]
+
+                    async def setup():
+                        return self.new_processor(info)
+
+                    async def run(processor):
+                        segments = await processor.split_media(source, timestamps, is_video)
+                        if len(segments) != len(timestamps):
+                            raise RuntimeError(f"split_media вернул {len(segments)} сегментов из {len(timestamps)}")
+
+                    samples = await measure(self.repeat, setup, run, lambda p: p.cleanup())
+                    params = {'duration': duration, 'chapters': count, 'is_video': is_video}
+                    self.results.append(summarize('split_media', params, samples))
+
+    async def bench_full_flow(self):
+        import bot
+        import pipeline
+
+        db.DATABASE_FILE = self.work_dir / 'bench.db'
+        db.initialize_db()
+        db.create_user(BENCH_USER_ID)
+        storage.storage_manager = storage.StorageManager(root=str(self.work_dir / 'jobs'))
+        pipeline.STREAM_AUDIO_TRANSCODE = False
+        pipeline.UPLOAD_PAUSE = self.upload_pause
+
+        for duration in self.durations:
+            for count in self.chapters:
+                url = self.register(f'full_{duration}_{count}', duration, count)
+                for is_video in (False, True):
+                    fake_bot = FakeBot()
+                    context = SimpleNamespace(bot=fake_bot)
+
+                    async def setup():
+                        bot.user_process_locks[BENCH_USER_ID] = asyncio.Lock()
+                        state = bot.get_user_state(BENCH_USER_ID)
+                        state.update({'url': url, 'is_video': is_video, 'by_timestamps': count > 1,
+                                      'source_message_id': 1})
+
+                    async def run(_):
+                        await bot.start_download_process(BENCH_USER_ID, context)
+
+                    samples = await measure(self.repeat, setup, run, _noop)
+                    uploads = fake_bot.calls.get('send_video' if is_video else 'send_audio', 0)
+                    pause = uploads // self.repeat * self.upload_pause
+                    params = {'duration': duration, 'chapters': count, 'is_video': is_video}
+                    extra = {'uploads_per_run': uploads // self.repeat,
+                             'upload_pause_s': self.upload_pause,
+                             'pipeline_median_s': statistics.median(samples) - pause,
+                             'uploaded_bytes_per_run': fake_bot.uploaded_bytes // self.repeat,
+                             'bot_calls': fake_bot.calls}
+                    self.results.append(summarize('start_download_process', params, samples, extra))
+
+    async def run(self) -> Dict[str, Any]:
+        install_fake_yt_dlp()
+        await self.bench_parse_timestamps()
+        await self.bench_process_thumbnail()
+        await self.bench_add_metadata()
+        await self.bench_split_media()
+        if self.include_full_flow:
+            await self.bench_full_flow()
+        return {'meta': environment_info(self), 'results': self.results}
+
+
+async def _noop(*args):
+    return None
+
+
+def environment_info(benchmark: Benchmark) -> Dict[str, Any]:
+    try:
+        ffmpeg_version = subprocess.run(['ffmpeg', '-version'], capture_output=True, text=True).stdout.splitlines()[0]
+    except (OSError, IndexError):
+        ffmpeg_version = None
+    try:
+        revision = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                  cwd=Path(__file__).resolve().parent).stdout.strip() or None
+    except OSError:
+        revision = None
+    return {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'ffmpeg': ffmpeg_version,
+        'git_revision': revision,
+        'durations': benchmark.durations,
+        'chapters': benchmark.chapters,
+        'repeat': benchmark.repeat,
+        'upload_pause': benchmark.upload_pause,
+    }
+
+
+def parse_int_list(value: str) -> List[int]:
+    return [int(item) for item in value.split(',') if item.strip()]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк медиа-конвейера на синтетических файлах")
+    parser.add_argument('--durations', type=parse_int_list, default=[60, 600], help="длительности в секундах")
+    parser.add_argument('--chapters', type=parse_int_list, default=[1, 10, 30], help="количество глав")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--skip-full-flow', action='store_true', help="не запускать start_download_process")
+    parser.add_argument('--upload-pause', type=float, default=0.0,
+                        help="пауза после каждой отправки, как UPLOAD_PAUSE в боте (по умолчанию без паузы)")
+    parser.add_argument('--work-dir', type=Path, default=None, help="каталог для синтетических файлов (кэшируется)")
+    parser.add_argument('--output', type=Path, default=None, help="файл для JSON-результатов (по умолчанию stdout)")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(name)s [%(levelname)s] - %(message)s', level=logging.WARNING)
+    logger.setLevel(logging.INFO)
+
+    if shutil.which('ffmpeg') is None:
+        logger.critical("ffmpeg не найден в PATH")
+        sys.exit(1)
+
+    cleanup_work_dir = args.work_dir is None
+    work_dir = args.work_dir or Path(tempfile.mkdtemp(prefix='video_bot_bench_'))
+    try:
+        benchmark = Benchmark(work_dir, args.durations, args.chapters, args.repeat, not args.skip_full_flow,
+                              args.upload_pause)
+        report = asyncio.run(benchmark.run())
+    finally:
+        if cleanup_work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        args.output.write_text(output, encoding='utf-8')
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
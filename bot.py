@@ -2,6 +2,7 @@ import asyncio
 import logging
 import os
 import re
+import sys
 import telegram.error
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
@@ -10,7 +11,15 @@ from telegram.ext import (
     ContextTypes, CallbackQueryHandler
 )
 import db
+import lazy_imports
+import loop_monitor
+import metrics
+import pipeline
 import settings
+import storage
+import task_queue
+import utils
+from scheduler import scheduler
 from status_manager import update_status_message
 from video_processor import VideoProcessor
 
@@ -24,11 +33,22 @@ logging.getLogger("httpx").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
 BOT_TOKEN = os.getenv('BOT_TOKEN')
-DOWNLOAD_FOLDER = os.getenv('DOWNLOAD_FOLDER', 'downloads')
 MAX_FILE_SIZE_MB = int(os.getenv('MAX_FILE_SIZE_MB', '50'))
+PREWARM_IMPORTS = os.getenv('PREWARM_IMPORTS', '1') == '1'
+PREWARM_DELAY = float(os.getenv('PREWARM_DELAY', '1'))
+BATCH_MAX_LINKS = int(os.getenv('BATCH_MAX_LINKS', '50'))
+SPECULATIVE_PREFETCH = os.getenv('SPECULATIVE_PREFETCH', '0') == '1' and task_queue.JOB_MODE != 'queue'
+PREFETCH_TTL = float(os.getenv('PREFETCH_TTL', '600'))
+QUEUED_CANCEL_TIMEOUT = float(os.getenv('QUEUED_CANCEL_TIMEOUT', str(task_queue.JOB_LEASE_SECONDS * 2)))
 
 user_states = {}
 user_process_locks = {}
+job_queue = task_queue.get_job_queue() if task_queue.JOB_MODE == 'queue' else None
+queued_job_waiters: dict[int, asyncio.Future] = {}
+prefetch_jobs: dict[int, dict] = {}
+active_jobs: dict[int, dict] = {}
+last_job_event_id = 0
+job_queue_depth = 0
 
 
 def get_user_state(user_id: int) -> dict:
@@ -37,6 +57,9 @@ def get_user_state(user_id: int) -> dict:
             'is_video': False,
             'by_timestamps': True,
             'url': None,
+            'is_playlist': False,
+            'urls': None,
+            'duration': None,
             'source_message_id': None,
             'menu_message_id': None
         }
@@ -48,23 +71,6 @@ async def clear_user_state(user_id: int):
         del user_states[user_id]
 
 
-def get_audio_metadata(file_path):
-    try:
-        from mutagen.mp3 import MP3
-        from mutagen.id3 import ID3NoHeaderError
-
-        audio = MP3(str(file_path))
-        if audio.tags:
-            title = str(audio.tags.get('TIT2', ['Unknown'])[0]) if audio.tags.get('TIT2') else 'Unknown'
-            artist = str(audio.tags.get('TPE1', ['Unknown'])[0]) if audio.tags.get('TPE1') else 'Unknown'
-            duration = int(audio.info.length) if audio.info.length else 0
-            return title, artist, duration
-    except Exception as e:
-        logger.warning(f"Ошибка чтения метаданных из {file_path}: {e}")
-
-    return 'Unknown', 'Unknown', 0
-
-
 async def delete_message_after_delay(context: ContextTypes.DEFAULT_TYPE):
     chat_id = context.job.chat_id
     message_id = context.job.data['message_id']
@@ -76,28 +82,72 @@ async def delete_message_after_delay(context: ContextTypes.DEFAULT_TYPE):
 
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     logger.error("Исключение при обработке обновления:", exc_info=context.error)
+    if isinstance(context.error, telegram.error.RetryAfter):
+        metrics.count_retry_after('update_handler')
     if isinstance(update, Update) and update.effective_user:
         if isinstance(context.error, telegram.error.Forbidden):
-            db.disable_user(update.effective_user.id)
+            await asyncio.get_running_loop().run_in_executor(None, db.disable_user, update.effective_user.id)
+
+
+metrics_server = metrics.MetricsServer()
 
 
 async def post_init(application: Application) -> None:
+    global last_job_event_id
+    asyncio.get_running_loop().set_default_executor(metrics.executor)
+    if loop_monitor.LOOP_MONITOR:
+        loop_monitor.monitor.start()
+    if metrics.METRICS_PORT:
+        await metrics_server.start()
+
+    await asyncio.get_running_loop().run_in_executor(None, db.cancel_speculative_jobs)
+    await asyncio.get_running_loop().run_in_executor(None, pipeline.sweep_job_dirs, 0, job_queue)
+    if application.job_queue:
+        application.job_queue.run_repeating(sweep_storage, interval=storage.STORAGE_SWEEP_INTERVAL,
+                                            first=storage.STORAGE_SWEEP_INTERVAL)
+        if SPECULATIVE_PREFETCH:
+            application.job_queue.run_repeating(expire_prefetches, interval=PREFETCH_TTL / 2, first=PREFETCH_TTL / 2)
+        if PREWARM_IMPORTS and task_queue.JOB_MODE != 'queue':
+            application.job_queue.run_once(prewarm_imports, PREWARM_DELAY)
+        if job_queue:
+            last_job_event_id = await asyncio.get_running_loop().run_in_executor(None, job_queue.last_event_id)
+            application.job_queue.run_repeating(relay_job_events, interval=task_queue.JOB_POLL_INTERVAL)
+            metrics.registry.gauge('syntube_job_queue_depth', 'Задачи, ожидающие воркера', lambda: job_queue_depth)
+
     logger.info("Bot post_init: Сброс 'зависших' статусов...")
-    for user_data in db.get_all_users_with_status_message():
+    for user_data in await asyncio.get_running_loop().run_in_executor(None, db.get_all_users_with_status_message):
         try:
             await update_status_message(user_data['user_id'], application.bot, "⏱️ Ожидание")
             await asyncio.sleep(0.5)
         except Exception as e:
             logger.error(f"Ошибка в post_init для user {user_data['user_id']}: {e}")
 
+    if task_queue.JOB_MODE != 'queue':
+        await resume_local_jobs(application)
+
+
+async def prewarm_imports(context: ContextTypes.DEFAULT_TYPE):
+    await asyncio.get_running_loop().run_in_executor(None, lazy_imports.prewarm)
+
+
+async def sweep_storage(context: ContextTypes.DEFAULT_TYPE):
+    await asyncio.get_running_loop().run_in_executor(
+        None, pipeline.sweep_job_dirs, storage.ORPHAN_MAX_AGE, job_queue)
+
+
+async def post_shutdown(application: Application) -> None:
+    await metrics_server.stop()
+    await loop_monitor.monitor.stop()
+
 
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    is_new_user = not db.get_user_settings(user.id)
+    loop = asyncio.get_running_loop()
+    is_new_user = not await loop.run_in_executor(None, db.get_user_settings, user.id)
     if update.message:
         await update.message.delete()
     if is_new_user:
-        db.create_user(user.id)
+        await loop.run_in_executor(None, db.create_user, user.id)
         await update_status_message(user.id, context.bot, "⏱️ Ожидание")
     sent_msg = await update.effective_chat.send_message(settings.WELCOME_MESSAGE)
     if context.job_queue:
@@ -117,12 +167,16 @@ def create_options_keyboard(user_id: int) -> InlineKeyboardMarkup:
     ])
 
 
+def create_cancel_keyboard() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([[InlineKeyboardButton(settings.BUTTON_CANCEL, callback_data="cancel_job")]])
+
+
 async def handle_link(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
     url_pattern = r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+'
-    url_match = re.search(url_pattern, update.message.text)
-    if not url_match: return
-    url = url_match.group(0)
+    urls = unique_links(re.findall(url_pattern, update.message.text))
+    if not urls: return
+    url = urls[0]
 
     if user_id not in user_process_locks:
         user_process_locks[user_id] = asyncio.Lock()
@@ -138,28 +192,80 @@ async def handle_link(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
             await context.bot.delete_message(chat_id=user_id, message_id=state['menu_message_id'])
         except telegram.error.TelegramError:
             pass
+    await discard_prefetch(user_id)
 
     state['url'] = url
+    state['urls'] = None
     state['source_message_id'] = update.message.message_id
+    if SPECULATIVE_PREFETCH:
+        await apply_last_choices(user_id, state)
+
+    if len(urls) > 1:
+        await show_batch_menu(update, user_id, state, urls)
+        return
 
     processor = VideoProcessor()
     try:
-        video_info = await processor.get_video_info(url)
-        title = video_info.get('title', 'Неизвестное видео')[:50]
-        duration = video_info.get('duration', 0)
-        duration_str = f"{duration // 60}:{duration % 60:02d}" if duration else "неизвестно"
-        message_text = f"🎬 **{title}**\n⏱️ Длительность: {duration_str}\n\nВыберите параметры загрузки:"
+        video_info = await processor.probe_link(url)
+        state['is_playlist'] = VideoProcessor.is_playlist(video_info)
+        state['duration'] = video_info.get('duration')
+        title = (video_info.get('title') or 'Неизвестное видео')[:50]
+        if state['is_playlist']:
+            count = video_info.get('playlist_count') or len(video_info.get('entries') or [])
+            message_text = f"📃 **{title}**\n🎞️ Видео в плейлисте: {count or 'неизвестно'}\n\nВыберите параметры загрузки:"
+        else:
+            duration = int(video_info.get('duration') or 0)
+            duration_str = f"{duration // 60}:{duration % 60:02d}" if duration else "неизвестно"
+            message_text = f"🎬 **{title}**\n⏱️ Длительность: {duration_str}\n\nВыберите параметры загрузки:"
         keyboard = create_options_keyboard(user_id)
-        sent_menu = await update.message.reply_text(message_text, reply_markup=keyboard, parse_mode='Markdown')
+        sent_menu = await reply_with_retry(update.message, message_text, reply_markup=keyboard, parse_mode='Markdown')
         state['menu_message_id'] = sent_menu.message_id
+        if SPECULATIVE_PREFETCH and not state['is_playlist']:
+            await start_prefetch(user_id, state)
     except Exception as e:
         logger.error(f"Ошибка при обработке ссылки для user {user_id}: {e}", exc_info=True)
-        await update.message.reply_text(f"❌ Ошибка: Не удалось обработать ссылку.", quote=True)
+        await update.message.reply_text(f"❌ Ошибка: Не удалось обработать ссылку.", do_quote=True)
         await clear_user_state(user_id)
     finally:
         await processor.cleanup()
 
 
+async def reply_with_retry(message, text: str, **kwargs):
+    return await utils.call_with_retry(lambda: message.reply_text(text, **kwargs), 'reply_text')
+
+
+def unique_links(urls: list[str]) -> list[str]:
+    seen = set()
+    unique = []
+    for url in urls:
+        url = url.rstrip('.,;)')
+        key = utils.extract_video_id(url) or url.rstrip('/')
+        if key not in seen:
+            seen.add(key)
+            unique.append(url)
+    return unique
+
+
+async def show_batch_menu(update: Update, user_id: int, state: dict, urls: list[str]):
+    if len(urls) > BATCH_MAX_LINKS:
+        await update.message.reply_text(
+            f"ℹ️ В сообщении {len(urls)} ссылок, будут обработаны первые {BATCH_MAX_LINKS}.", do_quote=True)
+        urls = urls[:BATCH_MAX_LINKS]
+    state['urls'] = urls
+    state['is_playlist'] = False
+    state['duration'] = None
+
+    platforms = {}
+    for url in urls:
+        platform = utils.get_platform_name(url)
+        platforms[platform] = platforms.get(platform, 0) + 1
+    platforms_text = ", ".join(f"{name}: {count}" for name, count in platforms.items())
+    message_text = f"📦 **Пакет ссылок: {len(urls)}**\n🌐 {platforms_text}\n\nВыберите параметры загрузки:"
+    sent_menu = await reply_with_retry(update.message, message_text, reply_markup=create_options_keyboard(user_id),
+                                                parse_mode='Markdown')
+    state['menu_message_id'] = sent_menu.message_id
+
+
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     user_id = query.from_user.id
@@ -171,142 +277,307 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if data == "toggle_video_audio":
         state['is_video'] = not state['is_video']
         await query.edit_message_reply_markup(reply_markup=create_options_keyboard(user_id))
+        prefetch = prefetch_jobs.get(user_id)
+        if prefetch and prefetch['is_video'] != state['is_video']:
+            await discard_prefetch(user_id)
     elif data == "toggle_timestamps":
         state['by_timestamps'] = not state['by_timestamps']
         await query.edit_message_reply_markup(reply_markup=create_options_keyboard(user_id))
     elif data == "cancel":
         await query.message.delete()
         await clear_user_state(user_id)
+        await discard_prefetch(user_id)
+    elif data == "cancel_job":
+        await cancel_active_job(user_id)
     elif data == "download":
         await query.message.delete()
+        await asyncio.get_running_loop().run_in_executor(
+            None, db.update_user_choices, user_id, state['is_video'], state['by_timestamps'])
         asyncio.create_task(start_download_process(user_id, context))
 
 
+async def apply_last_choices(user_id: int, state: dict):
+    user_settings = await asyncio.get_running_loop().run_in_executor(None, db.get_user_settings, user_id)
+    if user_settings and user_settings.get('last_is_video') is not None:
+        state['is_video'] = bool(user_settings['last_is_video'])
+        state['by_timestamps'] = bool(user_settings['last_by_timestamps'])
+
+
+async def start_prefetch(user_id: int, state: dict):
+    loop = asyncio.get_running_loop()
+    job = pipeline.build_job(user_id, state)
+    job['by_timestamps'] = True
+    job_id = await loop.run_in_executor(None, db.create_job, user_id, job, 'speculative', task_queue.LOCAL_WORKER_ID)
+    if job_id is None:
+        return
+    task = scheduler.start_speculative(
+        pipeline.prefetch(job, pipeline.JobCheckpoint(job_id), on_evict=lambda: evict_prefetch(user_id, job_id)),
+        f"prefetch-{job_id}")
+    if not task:
+        await loop.run_in_executor(None, db.finish_job, job_id, 'cancelled')
+        return
+    prefetch_jobs[user_id] = {'task': task, 'job_id': job_id, 'url': job['url'], 'is_video': job['is_video'],
+                              'started_at': loop.time()}
+    logger.info(f"Спекулятивная подготовка задачи {job_id} для user {user_id} запущена")
+
+
+def prefetch_reservation(prefetch: dict) -> storage.Reservation | None:
+    task = prefetch['task']
+    return task.result() if task.done() and not task.cancelled() and not task.exception() else None
+
+
+async def discard_prefetch(user_id: int):
+    prefetch = prefetch_jobs.pop(user_id, None)
+    if not prefetch:
+        return
+    prefetch['task'].cancel()
+    await asyncio.gather(prefetch['task'], return_exceptions=True)
+    reservation = prefetch_reservation(prefetch)
+    if reservation:
+        await reservation.release()
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, storage.storage_manager.remove_job_dir, storage.job_dir_name(prefetch['job_id']))
+    await loop.run_in_executor(None, db.finish_job, prefetch['job_id'], 'cancelled')
+
+
+async def evict_prefetch(user_id: int, job_id: int):
+    prefetch = prefetch_jobs.get(user_id)
+    if prefetch and prefetch['job_id'] == job_id:
+        logger.info(f"Спекулятивная подготовка задачи {job_id} для user {user_id} вытеснена из хранилища")
+        await discard_prefetch(user_id)
+
+
+async def expire_prefetches(context: ContextTypes.DEFAULT_TYPE):
+    now = asyncio.get_running_loop().time()
+    for user_id, prefetch in list(prefetch_jobs.items()):
+        if now - prefetch['started_at'] > PREFETCH_TTL and prefetch_jobs.get(user_id) is prefetch:
+            logger.info(f"Спекулятивная подготовка задачи {prefetch['job_id']} для user {user_id} устарела")
+            await discard_prefetch(user_id)
+
+
+async def take_prefetch(user_id: int, job: dict, bot) -> pipeline.JobCheckpoint | None:
+    prefetch = prefetch_jobs.get(user_id)
+    if not prefetch:
+        return None
+    if prefetch['url'] != job['url'] or prefetch['is_video'] != job['is_video']:
+        await discard_prefetch(user_id)
+        return None
+    prefetch_jobs.pop(user_id)
+    if not prefetch['task'].done():
+        await update_status_message(user_id, bot, "🔍 Анализ ссылки...")
+        await asyncio.gather(prefetch['task'], return_exceptions=True)
+
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, db.activate_job, prefetch['job_id'], job)
+    checkpoint = pipeline.JobCheckpoint.from_job(await loop.run_in_executor(None, db.get_job, prefetch['job_id']))
+    checkpoint.reservation = prefetch_reservation(prefetch)
+    if checkpoint.reservation:
+        checkpoint.reservation.on_evict = None
+    if checkpoint.stage:
+        checkpoint.data['by_timestamps'] = job['by_timestamps'] and bool(checkpoint.data.get('timestamps'))
+    logger.info(f"Задача {checkpoint.job_id} для user {user_id} использует спекулятивную подготовку "
+                f"(этап: {checkpoint.stage or 'начало'})")
+    return checkpoint
+
+
 async def start_download_process(user_id: int, context: ContextTypes.DEFAULT_TYPE):
+    await run_user_job(user_id, context.bot)
+
+
+async def run_user_job(user_id: int, bot, stored_job: dict | None = None):
     lock = user_process_locks.get(user_id)
     if not lock or lock.locked():
         return
 
     async with lock:
-        state = get_user_state(user_id)
-        processor = VideoProcessor()
-        url = state['url']
-        is_video = state['is_video']
-        by_timestamps = state['by_timestamps']
-        source_message_id = state['source_message_id']
-
+        active = active_jobs[user_id] = {'task': asyncio.current_task(), 'bot': bot, 'job_id': None,
+                                         'checkpoint': None, 'cancelled': False}
         try:
-            await update_status_message(user_id, context.bot, "🔍 Анализ ссылки...")
-            video_info = await processor.get_video_info(url)
-            if not video_info:
-                raise ValueError("Не удалось получить информацию о видео.")
-
-            timestamps = []
-            if by_timestamps:
-                await update_status_message(user_id, context.bot, "📝 Поиск таймкодов...")
-
-                await processor.get_video_comments(url)
-                timestamps = processor.get_all_timestamps(url)
-
-                if not timestamps:
-                    await update_status_message(user_id, context.bot, "ℹ️ Таймкоды не найдены, загружаю целиком.")
-                    await asyncio.sleep(3)
-                    by_timestamps = False
-                else:
-                    logger.info(f"Найдено {len(timestamps)} временных меток")
-
-            await update_status_message(user_id, context.bot, processor.create_progress_bar(0))
-            downloaded_file = await processor.download_media(url, is_video, progress_callback=None)
-
-            if not is_video:
-                await processor.download_thumbnail(url)
-
-            await update_status_message(user_id, context.bot, processor.create_progress_bar(50))
-
-            segments = []
-            if by_timestamps and timestamps:
-                segments = await processor.split_media(
-                    downloaded_file, timestamps, is_video,
-                    lambda p: update_status_message(user_id, context.bot,
-                                                    processor.create_progress_bar(int(50 + p * 0.3)))
-                )
+            if task_queue.JOB_MODE == 'queue':
+                await run_queued_job(user_id, pipeline.build_job(user_id, get_user_state(user_id)), bot)
             else:
-                segments = [downloaded_file]
-                if not is_video:
-                    video_title = video_info.get('title', 'Unknown Video')
-                    await processor.add_metadata_to_audio(
-                        file_path=downloaded_file,
-                        title="Full",
-                        artist=video_title
-                    )
-                    logger.info(f"Добавлены метаданные для полного трека: title='Full', artist='{video_title}'")
-
-            await update_status_message(user_id, context.bot, processor.create_progress_bar(80))
-
-            thumbnail_file = None
-            if not is_video and processor.thumbnail_path and processor.thumbnail_path.exists():
-                thumbnail_file = open(processor.thumbnail_path, 'rb')
-
-            total_segments = len(segments)
-            for i, segment_path in enumerate(segments):
-                upload_progress = int(((i + 1) / total_segments) * 100)
-                display_progress = int(80 + upload_progress * 0.2)
-                await update_status_message(user_id, context.bot, processor.create_progress_bar(display_progress))
-
-                file_size_mb = segment_path.stat().st_size / (1024 * 1024)
-                logger.info(f"Отправка файла {segment_path.name} размером {file_size_mb:.1f} МБ")
-
-                with open(segment_path, 'rb') as file_to_send:
-                    if thumbnail_file:
-                        thumbnail_file.seek(0)
-
-                    if is_video:
-                        await context.bot.send_video(
-                            chat_id=user_id,
-                            video=file_to_send,
-                            caption=f"🎬 {segment_path.stem}",
-                            reply_to_message_id=source_message_id
-                        )
-                    else:
-                        title, artist, duration = get_audio_metadata(segment_path)
-                        logger.info(
-                            f"Метаданные для {segment_path.name}: title='{title}', artist='{artist}', duration={duration}")
-
-                        await context.bot.send_audio(
-                            chat_id=user_id,
-                            audio=file_to_send,
-                            title=title,
-                            performer=artist,
-                            duration=duration,
-                            thumbnail=thumbnail_file,
-                            reply_to_message_id=source_message_id
-                        )
-                await asyncio.sleep(1)
-
-            if thumbnail_file:
-                thumbnail_file.close()
-
+                await run_local_job(user_id, bot, stored_job)
+        except asyncio.CancelledError:
+            if not active['cancelled']:
+                raise
+            asyncio.current_task().uncancel()
+            logger.info(f"Задача user {user_id} отменена пользователем")
+            await update_status_message(user_id, bot, "🚫 Задача отменена", force=True)
+            await asyncio.sleep(3)
         except Exception as e:
             logger.error(f"Ошибка в start_download_process для user {user_id}: {e}", exc_info=True)
-            await update_status_message(user_id, context.bot, f"❌ Ошибка: {str(e)[:100]}")
+            await update_status_message(user_id, bot, f"❌ Ошибка: {str(e)[:100]}", force=True)
             await asyncio.sleep(10)
         finally:
-            await processor.cleanup()
+            active_jobs.pop(user_id, None)
             await clear_user_state(user_id)
-            await update_status_message(user_id, context.bot, "⏱️ Ожидание")
+            await update_status_message(user_id, bot, "⏱️ Ожидание", force=True)
             logger.info(f"Обработка для user {user_id} завершена.")
 
 
-def main() -> None:
-    if not BOT_TOKEN:
-        logger.critical("BOT_TOKEN не найден в .env файле!")
+async def run_local_job(user_id: int, bot, stored_job: dict | None = None):
+    loop = asyncio.get_running_loop()
+    if stored_job:
+        job = stored_job['payload']
+        checkpoint = pipeline.JobCheckpoint.from_job(stored_job)
+    else:
+        job = pipeline.build_job(user_id, get_user_state(user_id))
+        checkpoint = await take_prefetch(user_id, job, bot)
+        if checkpoint is None:
+            job_id = await loop.run_in_executor(None, db.create_job, user_id, job, 'running',
+                                                task_queue.LOCAL_WORKER_ID)
+            checkpoint = pipeline.JobCheckpoint(job_id)
+
+    active = active_jobs[user_id]
+    active['job_id'] = checkpoint.job_id
+    active['checkpoint'] = checkpoint
+
+    async def report(text: str):
+        await update_status_message(user_id, bot, text, reply_markup=create_cancel_keyboard())
+
+    keep_files = False
+    try:
+        async with scheduler.job_slot(on_wait=lambda: report("⏳ Ожидание свободного слота...")):
+            await pipeline.run_job(job, bot, report, checkpoint)
+    except asyncio.CancelledError:
+        keep_files = not checkpoint.cancelled
+        if checkpoint.cancelled:
+            await asyncio.shield(loop.run_in_executor(None, db.finish_job, checkpoint.job_id, 'cancelled'))
+        raise
+    except Exception as e:
+        await loop.run_in_executor(None, db.finish_job, checkpoint.job_id, 'failed', str(e)[:100])
+        raise
+    finally:
+        if checkpoint.reservation:
+            await checkpoint.reservation.release(keep_files)
+    await loop.run_in_executor(None, db.finish_job, checkpoint.job_id, 'done')
+
+
+async def cancel_active_job(user_id: int):
+    active = active_jobs.get(user_id)
+    if not active or active['cancelled']:
         return
-    db.initialize_db()
-    application = Application.builder().token(BOT_TOKEN).post_init(post_init).build()
+    active['cancelled'] = True
+    logger.info(f"Пользователь {user_id} запросил отмену задачи {active['job_id']}")
+    if task_queue.JOB_MODE == 'queue':
+        if active['job_id'] is not None:
+            await asyncio.get_running_loop().run_in_executor(None, job_queue.cancel, active['job_id'], user_id)
+        await update_status_message(user_id, active['bot'], "⏳ Отмена задачи...", force=True)
+        return
+    if active['checkpoint']:
+        active['checkpoint'].cancelled = True
+    active['task'].cancel()
+
+
+async def resume_local_jobs(application: Application):
+    latest_jobs = {}
+    for job in await asyncio.get_running_loop().run_in_executor(
+            None, task_queue.local_queue.unfinished, task_queue.LOCAL_WORKER_ID):
+        superseded = latest_jobs.get(job['user_id'])
+        if superseded:
+            await asyncio.get_running_loop().run_in_executor(
+                None, db.finish_job, superseded['job_id'], 'failed', 'superseded')
+        latest_jobs[job['user_id']] = job
+
+    for user_id, job in latest_jobs.items():
+        logger.info(f"Возобновление задачи {job['job_id']} для user {user_id} (этап: {job['stage'] or 'начало'})")
+        user_process_locks.setdefault(user_id, asyncio.Lock())
+        application.create_task(run_user_job(user_id, application.bot, job))
+
+
+async def run_queued_job(user_id: int, job: dict, bot):
+    loop = asyncio.get_running_loop()
+    job_id = await loop.run_in_executor(None, job_queue.enqueue, user_id, job)
+    finished = loop.create_future()
+    queued_job_waiters[job_id] = finished
+    active = active_jobs[user_id]
+    active['job_id'] = job_id
+    logger.info(f"Задача {job_id} для user {user_id} поставлена в очередь")
+    try:
+        if active['cancelled']:
+            await loop.run_in_executor(None, job_queue.cancel, job_id, user_id)
+        else:
+            await update_status_message(user_id, bot, "🕒 Задача в очереди...", reply_markup=create_cancel_keyboard())
+        kind = await wait_queued_job(user_id, job_id, finished, bot)
+    finally:
+        queued_job_waiters.pop(job_id, None)
+    if kind != 'done':
+        await asyncio.sleep(10 if kind == 'failed' else 3)
+
+
+async def wait_queued_job(user_id: int, job_id: int, finished: asyncio.Future, bot) -> str:
+    loop = asyncio.get_running_loop()
+    active = active_jobs[user_id]
+    cancelled_at = None
+    while True:
+        try:
+            return await asyncio.wait_for(asyncio.shield(finished), task_queue.JOB_LEASE_SECONDS / 3)
+        except asyncio.TimeoutError:
+            pass
+        if not active['cancelled']:
+            continue
+        cancelled_at = cancelled_at or loop.time()
+        await loop.run_in_executor(None, job_queue.expire_cancelling)
+        if loop.time() - cancelled_at > QUEUED_CANCEL_TIMEOUT:
+            logger.warning(f"Отмена задачи {job_id} не подтверждена за {QUEUED_CANCEL_TIMEOUT:.0f} с, ожидание прекращено")
+            await update_status_message(user_id, bot, "🚫 Задача отменена", force=True)
+            return 'cancelled'
+
+
+async def relay_job_events(context: ContextTypes.DEFAULT_TYPE):
+    global last_job_event_id, job_queue_depth
+    loop = asyncio.get_running_loop()
+    events = await loop.run_in_executor(None, job_queue.events, last_job_event_id)
+    job_queue_depth = await loop.run_in_executor(None, job_queue.depth)
+    for event in events:
+        last_job_event_id = event['event_id']
+        user_id = event['user_id']
+        if event['kind'] == 'progress':
+            active = active_jobs.get(user_id)
+            if not active or not active['cancelled']:
+                await update_status_message(user_id, context.bot, event['text'],
+                                            reply_markup=create_cancel_keyboard() if active else None)
+            continue
+        if event['kind'] == 'failed':
+            await update_status_message(user_id, context.bot, f"❌ Ошибка: {event['text']}", force=True)
+        elif event['kind'] == 'cancelled':
+            await update_status_message(user_id, context.bot, "🚫 Задача отменена", force=True)
+        waiter = queued_job_waiters.get(event['job_id'])
+        if waiter and not waiter.done():
+            waiter.set_result(event['kind'])
+        elif not waiter:
+            await update_status_message(user_id, context.bot, "⏱️ Ожидание", force=True)
+
+
+def build_application(token: str, base_url: str | None = None) -> Application:
+    builder = Application.builder().token(token).post_init(post_init).post_shutdown(post_shutdown)
+    if base_url:
+        builder = builder.base_url(base_url)
+    application = builder.build()
     application.add_error_handler(error_handler)
     application.add_handler(CommandHandler("start", start_command))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_link))
     application.add_handler(CallbackQueryHandler(button_callback))
+    return application
+
+
+def profile_startup(as_json: bool = False) -> None:
+    import startup_profile
+    startup_profile.run([
+        ('db.initialize_db', db.initialize_db),
+        ('build_application', lambda: build_application(BOT_TOKEN or '0:profile')),
+    ], as_json)
+
+
+def main() -> None:
+    if '--profile-startup' in sys.argv:
+        profile_startup(as_json='--json' in sys.argv)
+        return
+    if not BOT_TOKEN:
+        logger.critical("BOT_TOKEN не найден в .env файле!")
+        return
+    db.initialize_db()
+    application = build_application(BOT_TOKEN)
     logger.info("Бот запускается...")
     application.run_polling(allowed_updates=Update.ALL_TYPES)
 
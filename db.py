@@ -1,4 +1,6 @@
+import json
 import sqlite3
+import time
 from pathlib import Path
 import logging
 
@@ -11,25 +13,66 @@ def _execute_query(query, params=(), fetchone=False, fetchall=False):
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cursor.execute(query, params)
-            conn.commit()
+            result = None
             if fetchone:
-                return cursor.fetchone()
-            if fetchall:
-                return cursor.fetchall()
+                result = cursor.fetchone()
+            elif fetchall:
+                result = cursor.fetchall()
+            conn.commit()
+            return result
     except sqlite3.Error as e:
         logger.error(f"Ошибка БД при выполнении запроса '{query[:50]}...': {e}")
         return None
 
 def initialize_db():
+    _execute_query("PRAGMA journal_mode=WAL", fetchone=True)
     _execute_query("""
     CREATE TABLE IF NOT EXISTS users (
         user_id INTEGER PRIMARY KEY,
         status_message_id INTEGER,
-        is_active BOOLEAN DEFAULT TRUE
+        is_active BOOLEAN DEFAULT TRUE,
+        last_is_video BOOLEAN,
+        last_by_timestamps BOOLEAN
+    )
+    """)
+    _add_missing_columns('users', {'last_is_video': 'BOOLEAN', 'last_by_timestamps': 'BOOLEAN'})
+    _execute_query("""
+    CREATE TABLE IF NOT EXISTS jobs (
+        job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        payload TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'queued',
+        worker_id TEXT,
+        error TEXT,
+        attempts INTEGER DEFAULT 0,
+        created_at REAL NOT NULL,
+        updated_at REAL NOT NULL,
+        heartbeat_at REAL,
+        stage TEXT,
+        checkpoint TEXT
+    )
+    """)
+    _add_missing_columns('jobs', {'stage': 'TEXT', 'checkpoint': 'TEXT'})
+    _execute_query("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, job_id)")
+    _execute_query("""
+    CREATE TABLE IF NOT EXISTS job_events (
+        event_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        job_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        text TEXT,
+        created_at REAL NOT NULL
     )
     """)
     logger.info("База данных инициализирована.")
 
+def _add_missing_columns(table: str, columns: dict):
+    rows = _execute_query(f"PRAGMA table_info({table})", fetchall=True) or []
+    existing = {row['name'] for row in rows}
+    for name, column_type in columns.items():
+        if name not in existing:
+            _execute_query(f"ALTER TABLE {table} ADD COLUMN {name} {column_type}")
+
 def create_user(user_id: int):
     _execute_query("INSERT INTO users (user_id) VALUES (?) ON CONFLICT(user_id) DO UPDATE SET is_active=TRUE", (user_id,))
 
@@ -40,9 +83,115 @@ def get_user_settings(user_id: int) -> dict | None:
 def update_user_status_message_id(user_id: int, message_id: int):
     _execute_query("UPDATE users SET status_message_id = ? WHERE user_id = ?", (message_id, user_id))
 
+def update_user_choices(user_id: int, is_video: bool, by_timestamps: bool):
+    _execute_query("UPDATE users SET last_is_video = ?, last_by_timestamps = ? WHERE user_id = ?",
+                   (is_video, by_timestamps, user_id))
+
 def get_all_users_with_status_message() -> list[dict]:
     rows = _execute_query("SELECT user_id, status_message_id FROM users WHERE is_active = TRUE AND status_message_id IS NOT NULL", fetchall=True)
     return [dict(row) for row in rows] if rows else []
 
 def disable_user(user_id: int):
-    _execute_query("UPDATE users SET is_active = FALSE WHERE user_id = ?", (user_id,))
\ No newline at end of file
+    _execute_query("UPDATE users SET is_active = FALSE WHERE user_id = ?", (user_id,))
+
+def create_job(user_id: int, payload: dict, status: str = 'queued', worker_id: str | None = None) -> int | None:
+    now = time.time()
+    row = _execute_query(
+        "INSERT INTO jobs (user_id, payload, status, worker_id, created_at, updated_at, heartbeat_at) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?) RETURNING job_id",
+        (user_id, json.dumps(payload, ensure_ascii=False), status, worker_id, now, now, now), fetchone=True)
+    return row['job_id'] if row else None
+
+def _job_from_row(row) -> dict | None:
+    if not row:
+        return None
+    job = dict(row)
+    job['payload'] = json.loads(job['payload'])
+    job['checkpoint'] = json.loads(job['checkpoint']) if job.get('checkpoint') else {}
+    return job
+
+def fail_exhausted_jobs(lease_seconds: float, max_attempts: int, local_worker_id: str) -> list[dict]:
+    rows = _execute_query(
+        "UPDATE jobs SET status = 'failed', error = 'attempts exhausted', updated_at = ? "
+        "WHERE status = 'running' AND worker_id IS NOT ? AND heartbeat_at < ? AND attempts >= ? "
+        "RETURNING job_id, user_id, attempts",
+        (time.time(), local_worker_id, time.time() - lease_seconds, max_attempts), fetchall=True)
+    return [dict(row) for row in rows] if rows else []
+
+def claim_job(worker_id: str, lease_seconds: float, max_attempts: int, local_worker_id: str) -> dict | None:
+    now = time.time()
+    row = _execute_query("""
+    UPDATE jobs SET status = 'running', worker_id = ?, attempts = attempts + 1, updated_at = ?, heartbeat_at = ?
+    WHERE job_id = (
+        SELECT job_id FROM jobs
+        WHERE status = 'queued'
+           OR (status = 'running' AND worker_id IS NOT ? AND heartbeat_at < ? AND attempts < ?)
+        ORDER BY job_id LIMIT 1
+    )
+    RETURNING *
+    """, (worker_id, now, now, local_worker_id, now - lease_seconds, max_attempts), fetchone=True)
+    return _job_from_row(row)
+
+def heartbeat_job(job_id: int, worker_id: str):
+    _execute_query("UPDATE jobs SET heartbeat_at = ? WHERE job_id = ? AND worker_id = ?",
+                   (time.time(), job_id, worker_id))
+
+def finish_job(job_id: int, status: str, error: str | None = None):
+    _execute_query("UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE job_id = ?",
+                   (status, error, time.time(), job_id))
+
+def cancel_job(job_id: int, lease_seconds: float) -> str | None:
+    row = _execute_query(
+        "UPDATE jobs SET status = CASE WHEN status = 'queued' OR heartbeat_at < ? THEN 'cancelled' ELSE 'cancelling' END, "
+        "updated_at = ? WHERE job_id = ? AND status IN ('queued', 'running') RETURNING status",
+        (time.time() - lease_seconds, time.time(), job_id), fetchone=True)
+    return row['status'] if row else None
+
+def cancel_speculative_jobs():
+    _execute_query("UPDATE jobs SET status = 'cancelled', updated_at = ? WHERE status = 'speculative'", (time.time(),))
+
+def finish_stale_cancelling_jobs(lease_seconds: float) -> list[dict]:
+    rows = _execute_query(
+        "UPDATE jobs SET status = 'cancelled', updated_at = ? WHERE status = 'cancelling' AND heartbeat_at < ? "
+        "RETURNING job_id, user_id", (time.time(), time.time() - lease_seconds), fetchall=True)
+    return [dict(row) for row in rows] if rows else []
+
+def activate_job(job_id: int, payload: dict):
+    _execute_query("UPDATE jobs SET status = 'running', payload = ?, updated_at = ?, heartbeat_at = ? WHERE job_id = ?",
+                   (json.dumps(payload, ensure_ascii=False), time.time(), time.time(), job_id))
+
+def update_job_checkpoint(job_id: int, stage: str, checkpoint: dict):
+    _execute_query("UPDATE jobs SET stage = ?, checkpoint = ?, updated_at = ? WHERE job_id = ?",
+                   (stage, json.dumps(checkpoint, ensure_ascii=False), time.time(), job_id))
+
+def get_unfinished_jobs(worker_id: str | None = None) -> list[dict]:
+    if worker_id is None:
+        rows = _execute_query("SELECT * FROM jobs WHERE status IN ('queued', 'running', 'cancelling') ORDER BY job_id",
+                              fetchall=True)
+    else:
+        rows = _execute_query("SELECT * FROM jobs WHERE status = 'running' AND worker_id = ? ORDER BY job_id",
+                              (worker_id,), fetchall=True)
+    return [_job_from_row(row) for row in rows] if rows else []
+
+def get_job(job_id: int) -> dict | None:
+    return _job_from_row(_execute_query("SELECT * FROM jobs WHERE job_id = ?", (job_id,), fetchone=True))
+
+def count_jobs(status: str) -> int:
+    row = _execute_query("SELECT COUNT(*) AS total FROM jobs WHERE status = ?", (status,), fetchone=True)
+    return row['total'] if row else 0
+
+def add_job_event(job_id: int, user_id: int, kind: str, text: str | None = None):
+    _execute_query("INSERT INTO job_events (job_id, user_id, kind, text, created_at) VALUES (?, ?, ?, ?, ?)",
+                   (job_id, user_id, kind, text, time.time()))
+
+def get_job_events(after_event_id: int, limit: int = 200) -> list[dict]:
+    rows = _execute_query("SELECT * FROM job_events WHERE event_id > ? ORDER BY event_id LIMIT ?",
+                          (after_event_id, limit), fetchall=True)
+    return [dict(row) for row in rows] if rows else []
+
+def get_last_job_event_id() -> int:
+    row = _execute_query("SELECT MAX(event_id) AS last_id FROM job_events", fetchone=True)
+    return (row['last_id'] or 0) if row else 0
+
+def delete_old_job_events(older_than_seconds: float):
+    _execute_query("DELETE FROM job_events WHERE created_at < ?", (time.time() - older_than_seconds,))
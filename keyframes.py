@@ -0,0 +1,298 @@
+import asyncio
+import bisect
+import json
+import logging
+import os
+import re
+import shutil
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import storage
+from utils import run_process
+
+logger = logging.getLogger(__name__)
+
+KEYFRAME_SNAP = os.getenv('KEYFRAME_SNAP', '1') == '1'
+KEYFRAME_CACHE_DIR = os.getenv('KEYFRAME_CACHE_DIR', str(Path(storage.STORAGE_ROOT) / 'keyframes'))
+KEYFRAME_CACHE_MAX_AGE = float(os.getenv('KEYFRAME_CACHE_MAX_AGE', str(7 * 24 * 3600)))
+KEYFRAME_CACHE_MAX_MB = int(os.getenv('KEYFRAME_CACHE_MAX_MB', '50'))
+SMART_CUT = os.getenv('SMART_CUT', '0') == '1'
+SMART_CUT_PRESET = os.getenv('SMART_CUT_PRESET', 'veryfast')
+SMART_CUT_CRF = os.getenv('SMART_CUT_CRF', '18')
+SMART_CUT_ENCODERS = {'h264': ('libx264', '-x264-params', 'h264_mp4toannexb'),
+                      'hevc': ('libx265', '-x265-params', 'hevc_mp4toannexb')}
+
+EPSILON = 0.01
+MAX_REORDER_DELAY = 2
+
+
+class KeyframeIndex:
+    def __init__(self, times: List[float], codec: Optional[str] = None):
+        self.times = sorted(times)
+        self.codec = codec
+
+    def __len__(self) -> int:
+        return len(self.times)
+
+    def snap(self, time: float) -> float:
+        position = bisect.bisect_left(self.times, time)
+        candidates = self.times[max(0, position - 1):position + 1]
+        return min(candidates, key=lambda keyframe: abs(keyframe - time)) if candidates else time
+
+    def next_at_or_after(self, time: float) -> Optional[float]:
+        position = bisect.bisect_left(self.times, time - EPSILON)
+        return self.times[position] if position < len(self.times) else None
+
+    def prev_at_or_before(self, time: float) -> Optional[float]:
+        position = bisect.bisect_right(self.times, time + EPSILON)
+        return self.times[position - 1] if position else None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'codec': self.codec, 'times': self.times}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'KeyframeIndex':
+        return cls(data['times'], data.get('codec'))
+
+
+async def _probe_with_ffprobe(file_path: Path) -> KeyframeIndex:
+    returncode, output, errors = await run_process([
+        'ffprobe', '-v', 'error', '-select_streams', 'v:0',
+        '-show_entries', 'stream=codec_name:packet=pts_time,flags',
+        '-of', 'compact', str(file_path)
+    ])
+    if returncode != 0:
+        raise RuntimeError(f"ffprobe завершился с кодом {returncode}: {errors.strip()[-300:]}")
+
+    times, codec = [], None
+    for line in output.splitlines():
+        kind, _, rest = line.partition('|')
+        fields = dict(field.split('=', 1) for field in rest.split('|') if '=' in field)
+        if kind == 'stream':
+            codec = fields.get('codec_name')
+        elif kind == 'packet' and 'K' in fields.get('flags', '') and fields.get('pts_time') not in (None, 'N/A'):
+            times.append(float(fields['pts_time']))
+    return KeyframeIndex(times, codec)
+
+
+async def _probe_with_ffmpeg(file_path: Path) -> KeyframeIndex:
+    returncode, output, errors = await run_process([
+        'ffmpeg', '-hide_banner', '-v', 'error', '-i', str(file_path),
+        '-map', '0:v:0', '-c', 'copy', '-f', 'framecrc', '-'
+    ])
+    if returncode != 0:
+        raise RuntimeError(f"ffmpeg завершился с кодом {returncode}: {errors.strip()[-300:]}")
+
+    times, codec, time_base = [], None, 1.0
+    for line in output.splitlines():
+        if line.startswith('#tb 0:'):
+            numerator, denominator = line.split(':', 1)[1].strip().split('/')
+            time_base = int(numerator) / int(denominator)
+        elif line.startswith('#codec_id 0:'):
+            codec = line.split(':', 1)[1].strip()
+        elif not line.startswith('#') and 'F=' not in line:
+            columns = [column.strip() for column in line.split(',')]
+            if len(columns) >= 3 and re.fullmatch(r'-?\d+', columns[2]):
+                times.append(int(columns[2]) * time_base)
+    return KeyframeIndex(times, codec)
+
+
+async def probe_keyframes(file_path: Path) -> KeyframeIndex:
+    try:
+        return await _probe_with_ffprobe(file_path)
+    except FileNotFoundError:
+        logger.info("ffprobe не найден, индекс ключевых кадров строится через ffmpeg")
+        return await _probe_with_ffmpeg(file_path)
+
+
+def _cache_file(info: Dict[str, Any]) -> Optional[Path]:
+    video_id = info.get('id')
+    if not video_id:
+        return None
+    key = re.sub(r'[^\w.-]', '_', f"{info.get('extractor_key') or 'media'}-{video_id}")
+    return Path(KEYFRAME_CACHE_DIR) / f"{key}.json"
+
+
+def _load_cached(cache_file: Path, size: int) -> Optional[KeyframeIndex]:
+    try:
+        data = json.loads(cache_file.read_text())
+    except (OSError, ValueError):
+        return None
+    if data.get('size') != size:
+        return None
+    try:
+        cache_file.touch()
+    except OSError:
+        pass
+    return KeyframeIndex.from_dict(data)
+
+
+def _store_cached(cache_file: Path, size: int, index: KeyframeIndex):
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    cache_file.write_text(json.dumps({'size': size, **index.to_dict()}))
+
+
+def prune_cache(max_age: float = KEYFRAME_CACHE_MAX_AGE, max_mb: int = KEYFRAME_CACHE_MAX_MB) -> int:
+    entries = []
+    for cache_file in Path(KEYFRAME_CACHE_DIR).glob('*.json'):
+        try:
+            stat = cache_file.stat()
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, cache_file))
+    entries.sort(reverse=True)
+
+    removed = 0
+    total = 0
+    now = time.time()
+    for mtime, size, cache_file in entries:
+        total += size
+        if now - mtime > max_age or total > max_mb * storage.MB:
+            cache_file.unlink(missing_ok=True)
+            removed += 1
+    if removed:
+        logger.info(f"Удалено устаревших индексов ключевых кадров: {removed}")
+    return removed
+
+
+async def get_keyframe_index(file_path: Path, info: Optional[Dict[str, Any]]) -> Optional[KeyframeIndex]:
+    loop = asyncio.get_running_loop()
+    cache_file = _cache_file(info or {})
+    try:
+        size = (await loop.run_in_executor(None, file_path.stat)).st_size
+        if cache_file:
+            index = await loop.run_in_executor(None, _load_cached, cache_file, size)
+            if index:
+                logger.info(f"Индекс ключевых кадров для {file_path.name} загружен из кэша ({len(index)} кадров)")
+                return index
+
+        index = await probe_keyframes(file_path)
+        if not index.times:
+            return None
+        logger.info(f"Построен индекс ключевых кадров для {file_path.name}: {len(index)} кадров, кодек {index.codec}")
+        if cache_file:
+            await loop.run_in_executor(None, _store_cached, cache_file, size, index)
+        return index
+    except Exception as e:
+        logger.warning(f"Не удалось построить индекс ключевых кадров для {file_path.name}: {e}")
+        return None
+
+
+def snap_range(index: KeyframeIndex, start: float, end: float, is_last: bool) -> Tuple[float, float]:
+    snapped_start = index.snap(start)
+    snapped_end = end if is_last else index.snap(end)
+    if snapped_end - snapped_start < EPSILON:
+        return start, end
+    return snapped_start, snapped_end
+
+
+async def copy_cut(file_path: Path, start: float, end: float, output: Path) -> int:
+    returncode, _, errors = await run_process([
+        'ffmpeg', '-hide_banner', '-loglevel', 'error',
+        '-ss', f"{start:.3f}", '-i', str(file_path), '-t', f"{end - start:.3f}",
+        '-map', '0', '-c', 'copy', '-avoid_negative_ts', 'make_zero', '-y', str(output)
+    ])
+    if returncode != 0:
+        logger.error(f"Ошибка FFMPEG при копировании сегмента {output.name}: {errors.strip()[-300:]}")
+    return returncode
+
+
+async def _video_piece(file_path: Path, start: float, end: float, output: Path, codec_args: List[str]) -> int:
+    returncode, _, errors = await run_process([
+        'ffmpeg', '-hide_banner', '-loglevel', 'error',
+        '-ss', f"{start:.3f}", '-i', str(file_path), '-t', f"{end - start:.3f}",
+        '-map', '0:v:0', '-an', *codec_args, '-f', 'matroska', '-y', str(output)
+    ])
+    if returncode != 0:
+        logger.error(f"Ошибка FFMPEG при подготовке фрагмента {output.name}: {errors.strip()[-300:]}")
+    return returncode
+
+
+async def _reorder_delay(file_path: Path, start: float) -> Optional[Tuple[int, float]]:
+    returncode, output, errors = await run_process([
+        'ffmpeg', '-hide_banner', '-v', 'error', '-ss', f"{start:.3f}", '-i', str(file_path),
+        '-map', '0:v:0', '-c', 'copy', '-frames:v', '1', '-f', 'framecrc', '-'
+    ])
+    if returncode != 0:
+        logger.error(f"Ошибка FFMPEG при анализе {file_path.name}: {errors.strip()[-300:]}")
+        return None
+    time_base = 1.0
+    for line in output.splitlines():
+        if line.startswith('#tb 0:'):
+            numerator, denominator = line.split(':', 1)[1].strip().split('/')
+            time_base = int(numerator) / int(denominator)
+        elif not line.startswith('#'):
+            columns = [column.strip() for column in line.split(',')]
+            if len(columns) >= 4:
+                dts, pts, duration = int(columns[1]), int(columns[2]), int(columns[3])
+                return round((pts - dts) / duration) if duration > 0 else 0, (pts - dts) * time_base
+    return None
+
+
+def _encode_args(encoder: Tuple[str, str, str], reorder_delay: int) -> List[str]:
+    name, params_option, _ = encoder
+    params = 'repeat-headers=1'
+    if reorder_delay:
+        params += f":b-pyramid={reorder_delay - 1}"
+    return ['-c:v', name, '-bf', '3' if reorder_delay else '0', params_option, params,
+            '-preset', SMART_CUT_PRESET, '-crf', SMART_CUT_CRF]
+
+
+async def smart_cut(file_path: Path, start: float, end: float, output: Path, index: KeyframeIndex) -> Optional[int]:
+    encoder = SMART_CUT_ENCODERS.get(index.codec or '')
+    if not encoder:
+        return None
+
+    first_keyframe = index.next_at_or_after(start)
+    last_keyframe = index.prev_at_or_before(end)
+    if first_keyframe is None or last_keyframe is None or last_keyframe - first_keyframe < EPSILON:
+        plan = [(start, end, True)]
+    else:
+        plan = [(first_keyframe, last_keyframe, False)]
+        if first_keyframe - start > EPSILON:
+            plan.insert(0, (start, first_keyframe, True))
+        if end - last_keyframe > EPSILON:
+            plan.append((last_keyframe, end, True))
+
+    reorder_delay, delay_time = 0, 0.0
+    if any(not encode for _, _, encode in plan):
+        delay = await _reorder_delay(file_path, first_keyframe)
+        if delay is None:
+            return None
+        reorder_delay, delay_time = delay
+        if reorder_delay > MAX_REORDER_DELAY or await _reorder_delay(file_path, last_keyframe) != delay:
+            logger.info(f"Структура GOP источника {file_path.name} не поддерживается точной нарезкой")
+            return None
+
+    loop = asyncio.get_running_loop()
+    work_dir = output.with_name(f"{output.stem}.smartcut")
+    await loop.run_in_executor(None, lambda: work_dir.mkdir(exist_ok=True))
+    try:
+        pieces = []
+        for number, (piece_start, piece_end, encode) in enumerate(plan):
+            if encode:
+                codec_args = _encode_args(encoder, reorder_delay)
+            else:
+                drop = f"lt(pts*tb\\,{-EPSILON})+gte(dts*tb\\,{piece_end - piece_start - delay_time - EPSILON:.3f})"
+                codec_args = ['-c:v', 'copy', '-bsf:v', f"noise=drop={drop},{encoder[2]}"]
+            piece = work_dir / f"{number}.mkv"
+            returncode = await _video_piece(file_path, piece_start, piece_end, piece, codec_args)
+            if returncode != 0:
+                return returncode
+            pieces.append(piece)
+
+        concat_list = work_dir / 'pieces.txt'
+        await loop.run_in_executor(None, concat_list.write_text, ''.join(f"file '{piece.name}'\n" for piece in pieces))
+        returncode, _, errors = await run_process([
+            'ffmpeg', '-hide_banner', '-loglevel', 'error',
+            '-f', 'concat', '-safe', '0', '-i', str(concat_list),
+            '-ss', f"{start:.3f}", '-i', str(file_path), '-t', f"{end - start:.3f}",
+            '-map', '0:v', '-map', '1:a?', '-c', 'copy', '-shortest', '-y', str(output)
+        ])
+        if returncode != 0:
+            logger.error(f"Ошибка FFMPEG при сборке сегмента {output.name}: {errors.strip()[-300:]}")
+        return returncode
+    finally:
+        await loop.run_in_executor(None, shutil.rmtree, work_dir, True)
@@ -0,0 +1,66 @@
+import importlib
+import logging
+import threading
+import time
+from types import ModuleType
+from typing import Dict, Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+HEAVY_MODULES = ('yt_dlp', 'PIL.Image', 'mutagen.mp3', 'mutagen.id3', 'requests')
+
+import_timings: Dict[str, float] = {}
+_registry: Dict[str, 'LazyModule'] = {}
+_lock = threading.Lock()
+
+
+class LazyModule:
+    def __init__(self, name: str):
+        object.__setattr__(self, '_name', name)
+        object.__setattr__(self, '_module', None)
+
+    def _load(self) -> ModuleType:
+        module = object.__getattribute__(self, '_module')
+        if module is not None:
+            return module
+        name = object.__getattribute__(self, '_name')
+        with _lock:
+            module = object.__getattribute__(self, '_module')
+            if module is None:
+                started = time.perf_counter()
+                module = importlib.import_module(name)
+                import_timings[name] = time.perf_counter() - started
+                object.__setattr__(self, '_module', module)
+                logger.debug(f"Модуль {name} загружен за {import_timings[name]:.3f}s")
+        return module
+
+    @property
+    def loaded(self) -> bool:
+        return object.__getattribute__(self, '_module') is not None
+
+    def __getattr__(self, attr: str):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr: str, value):
+        setattr(self._load(), attr, value)
+
+    def __repr__(self) -> str:
+        name = object.__getattribute__(self, '_name')
+        return f"<lazy module '{name}' {'loaded' if self.loaded else 'not loaded'}>"
+
+
+def lazy_import(name: str) -> LazyModule:
+    with _lock:
+        if name not in _registry:
+            _registry[name] = LazyModule(name)
+        return _registry[name]
+
+
+def prewarm(names: Optional[Iterable[str]] = None):
+    started = time.perf_counter()
+    for name in names or HEAVY_MODULES:
+        try:
+            lazy_import(name)._load()
+        except ImportError as e:
+            logger.warning(f"Не удалось предзагрузить модуль {name}: {e}")
+    logger.info(f"Предзагрузка тяжёлых модулей завершена за {time.perf_counter() - started:.2f}s")
@@ -0,0 +1,395 @@
+import argparse
+import asyncio
+import email.parser
+import email.policy
+import json
+import logging
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set
+from urllib.parse import parse_qsl
+
+import benchmark
+import db
+import loop_monitor
+import storage
+
+logger = logging.getLogger(__name__)
+
+LOADTEST_TOKEN = '123456:LOADTEST'
+BOT_USER = {'id': 123456, 'is_bot': True, 'first_name': 'SynTube', 'username': 'syntube_loadtest_bot'}
+FIRST_USER_ID = 1_000_000
+IDLE_TEXT = "⏱️ Ожидание"
+MESSAGE_METHODS = {'sendMessage', 'editMessageText', 'editMessageReplyMarkup', 'sendAudio', 'sendVideo',
+                   'sendDocument'}
+STATUS_METHODS = {'sendMessage', 'editMessageText', 'pinChatMessage'}
+UPLOAD_METHODS = {'sendAudio', 'sendVideo', 'sendDocument'}
+
+
+def percentile(samples: List[float], fraction: float) -> Optional[float]:
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))], 4)
+
+
+class SimulatedUser:
+    def __init__(self, user_id: int, url: str):
+        self.user_id = user_id
+        self.url = url
+        self.menu: Optional[asyncio.Future] = None
+        self.finished: Optional[asyncio.Future] = None
+        self.link_sent_at: Optional[float] = None
+        self.first_file_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.error: Optional[str] = None
+        self.awaiting_result = False
+
+
+class FakeBotAPI:
+    def __init__(self, latency: float = 0.0, upload_latency: float = 0.0, retry_after_probability: float = 0.0,
+                 rate_limit: float = 0.0, host: str = '127.0.0.1'):
+        self.latency = latency
+        self.upload_latency = upload_latency
+        self.retry_after_probability = retry_after_probability
+        self.rate_limit = rate_limit
+        self.host = host
+        self.port: Optional[int] = None
+        self.users: Dict[int, SimulatedUser] = {}
+        self.calls: Dict[str, int] = {}
+        self.retry_after: Dict[str, int] = {}
+        self.uploaded_bytes = 0
+        self._updates: List[Dict[str, Any]] = []
+        self._update_id = 0
+        self._message_id = 0
+        self._updates_ready: Optional[asyncio.Condition] = None
+        self._rate_window = (0, 0)
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._connections: Set[asyncio.Task] = set()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}/bot"
+
+    async def start(self):
+        self._updates_ready = asyncio.Condition()
+        self._server = await asyncio.start_server(self._handle, self.host, 0, limit=2 ** 20)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"Фейковый Bot API слушает {self.base_url}")
+
+    async def stop(self):
+        for connection in self._connections:
+            connection.cancel()
+        await asyncio.gather(*self._connections, return_exceptions=True)
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def push_update(self, **update):
+        self._update_id += 1
+        async with self._updates_ready:
+            self._updates.append({'update_id': self._update_id, **update})
+            self._updates_ready.notify_all()
+
+    def next_message_id(self) -> int:
+        self._message_id += 1
+        return self._message_id
+
+    def user_message(self, user: SimulatedUser, text: str) -> Dict[str, Any]:
+        message = {
+            'message_id': self.next_message_id(), 'date': int(time.time()), 'text': text,
+            'chat': {'id': user.user_id, 'type': 'private'},
+            'from': {'id': user.user_id, 'is_bot': False, 'first_name': f'user{user.user_id}'},
+        }
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return message
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._connections.add(asyncio.current_task())
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                method = request_line.decode('latin-1').split()[1].rsplit('/', 1)[-1]
+                status, payload = await self._dispatch(method, self._parse_params(headers, body))
+                data = json.dumps(payload, ensure_ascii=False).encode()
+                writer.write(f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\n"
+                             f"Content-Length: {len(data)}\r\n\r\n".encode() + data)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self._connections.discard(asyncio.current_task())
+            writer.close()
+
+    def _parse_params(self, headers: Dict[str, str], body: bytes) -> Dict[str, Any]:
+        content_type = headers.get('content-type', '')
+        if content_type.startswith('multipart/form-data'):
+            message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+                f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+            params = {}
+            for part in message.iter_parts():
+                name = part.get_param('name', header='content-disposition')
+                payload = part.get_payload(decode=True) or b''
+                if part.get_filename():
+                    self.uploaded_bytes += len(payload)
+                else:
+                    params[name] = payload.decode()
+            return params
+        return dict(parse_qsl(body.decode()))
+
+    def _rate_limited(self) -> bool:
+        if not self.rate_limit:
+            return False
+        second, count = self._rate_window
+        now = int(time.monotonic())
+        if now != second:
+            second, count = now, 0
+        self._rate_window = (second, count + 1)
+        return count >= self.rate_limit
+
+    async def _dispatch(self, method: str, params: Dict[str, Any]):
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if method == 'getUpdates':
+            return '200 OK', {'ok': True, 'result': await self._get_updates(params)}
+
+        latency = self.upload_latency if method in UPLOAD_METHODS else self.latency
+        if latency:
+            await asyncio.sleep(random.expovariate(1 / latency))
+        if method in STATUS_METHODS | UPLOAD_METHODS and (
+                self._rate_limited() or random.random() < self.retry_after_probability):
+            self.retry_after[method] = self.retry_after.get(method, 0) + 1
+            return '429 Too Many Requests', {'ok': False, 'error_code': 429,
+                                             'description': 'Too Many Requests: retry after 1',
+                                             'parameters': {'retry_after': 1}}
+
+        if method == 'getMe':
+            return '200 OK', {'ok': True, 'result': BOT_USER}
+        if method not in MESSAGE_METHODS:
+            return '200 OK', {'ok': True, 'result': True}
+
+        chat_id = int(params.get('chat_id', 0))
+        message = {'message_id': int(params.get('message_id') or self.next_message_id()), 'date': int(time.time()),
+                   'chat': {'id': chat_id, 'type': 'private'}, 'from': BOT_USER}
+        if 'text' in params:
+            message['text'] = params['text']
+        if params.get('reply_markup'):
+            message['reply_markup'] = json.loads(params['reply_markup'])
+        self._observe(chat_id, method, message)
+        return '200 OK', {'ok': True, 'result': message}
+
+    async def _get_updates(self, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+        offset = int(params.get('offset') or 0)
+        timeout = float(params.get('timeout') or 0)
+        async with self._updates_ready:
+            self._updates = [update for update in self._updates if update['update_id'] >= offset]
+            if not self._updates and timeout:
+                try:
+                    await asyncio.wait_for(self._updates_ready.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            return self._updates[:100]
+
+    def _observe(self, chat_id: int, method: str, message: Dict[str, Any]):
+        user = self.users.get(chat_id)
+        if not user:
+            return
+        now = time.perf_counter()
+        buttons = [button.get('callback_data') for row in message.get('reply_markup', {}).get('inline_keyboard', [])
+                   for button in row]
+        if 'download' in buttons and user.menu and not user.menu.done():
+            user.menu.set_result(message)
+        elif user.menu and not user.menu.done() and message.get('text', '').startswith('❌'):
+            user.error = message['text']
+            user.finished_at = now
+            user.menu.set_result(None)
+        elif method in UPLOAD_METHODS and user.first_file_at is None:
+            user.first_file_at = now
+        elif user.awaiting_result and message.get('text', '').startswith('❌'):
+            user.error = message['text']
+        elif user.awaiting_result and message.get('text') == IDLE_TEXT:
+            user.awaiting_result = False
+            user.finished_at = now
+            if user.finished and not user.finished.done():
+                user.finished.set_result(None)
+
+
+class LoadTest:
+    def __init__(self, args: argparse.Namespace, work_dir: Path):
+        self.args = args
+        self.work_dir = work_dir
+        self.api = FakeBotAPI(args.latency, args.upload_latency, args.retry_after_probability, args.rate_limit)
+        self.loop_lag: List[float] = []
+
+    async def monitor_loop_lag(self, interval: float = 0.05):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(interval)
+            self.loop_lag.append(max(0.0, loop.time() - started - interval))
+
+    async def simulate_user(self, user: SimulatedUser, delay: float):
+        loop = asyncio.get_running_loop()
+        await asyncio.sleep(delay)
+        await self.api.push_update(message=self.api.user_message(user, '/start'))
+        await asyncio.sleep(self.args.think_time)
+
+        user.menu = loop.create_future()
+        user.finished = loop.create_future()
+        user.link_sent_at = time.perf_counter()
+        await self.api.push_update(message=self.api.user_message(user, user.url))
+        menu = await user.menu
+        if menu is None:
+            return
+        await asyncio.sleep(self.args.think_time)
+
+        callbacks = [] if self.args.chapters > 1 else ['toggle_timestamps']
+        if self.args.video:
+            callbacks.append('toggle_video_audio')
+        user.awaiting_result = True
+        for data in [*callbacks, 'download']:
+            await self.api.push_update(callback_query={
+                'id': str(self.api.next_message_id()), 'chat_instance': str(user.user_id), 'data': data,
+                'from': {'id': user.user_id, 'is_bot': False, 'first_name': f'user{user.user_id}'},
+                'message': menu,
+            })
+        await user.finished
+
+    async def run(self) -> Dict[str, Any]:
+        import bot
+        import pipeline
+
+        benchmark.install_fake_yt_dlp()
+        db.DATABASE_FILE = self.work_dir / 'loadtest.db'
+        db.initialize_db()
+        storage.storage_manager = storage.StorageManager(root=str(self.work_dir / 'jobs'))
+        pipeline.STREAM_AUDIO_TRANSCODE = False
+        bot.PREWARM_IMPORTS = False
+
+        media = benchmark.Benchmark(self.work_dir, [self.args.duration], [self.args.chapters], 1)
+        urls = [media.register(f'load_{index}', self.args.duration, self.args.chapters)
+                for index in range(self.args.videos)]
+        users = [SimulatedUser(FIRST_USER_ID + index, urls[index % len(urls)]) for index in range(self.args.users)]
+        self.api.users = {user.user_id: user for user in users}
+
+        await self.api.start()
+        lag_monitor = asyncio.create_task(self.monitor_loop_lag())
+        application = bot.build_application(LOADTEST_TOKEN, base_url=self.api.base_url)
+        started = time.perf_counter()
+        try:
+            async with application:
+                await bot.post_init(application)
+                await application.start()
+                await application.updater.start_polling(poll_interval=0, timeout=10)
+                simulations = [asyncio.create_task(self.simulate_user(user, random.uniform(0, self.args.ramp)))
+                               for user in users]
+                done, pending = await asyncio.wait(simulations, timeout=self.args.timeout)
+                for task in pending:
+                    task.cancel()
+                await asyncio.gather(*simulations, return_exceptions=True)
+                elapsed = time.perf_counter() - started
+                await application.updater.stop()
+                await application.stop()
+                await bot.post_shutdown(application)
+        finally:
+            lag_monitor.cancel()
+            await asyncio.gather(lag_monitor, return_exceptions=True)
+            await self.api.stop()
+        return self.report(users, elapsed)
+
+    def report(self, users: List[SimulatedUser], elapsed: float) -> Dict[str, Any]:
+        finished = [user for user in users if user.finished_at is not None]
+        succeeded = [user for user in finished if not user.error]
+        ttff = [user.first_file_at - user.link_sent_at for user in users if user.first_file_at is not None]
+        status_calls = sum(self.api.calls.get(method, 0) for method in STATUS_METHODS)
+        return {
+            'meta': {
+                'users': self.args.users, 'videos': self.args.videos, 'duration': self.args.duration,
+                'chapters': self.args.chapters, 'is_video': self.args.video, 'ramp': self.args.ramp,
+                'latency': self.args.latency, 'upload_latency': self.args.upload_latency,
+                'retry_after_probability': self.args.retry_after_probability, 'rate_limit': self.args.rate_limit,
+                'python': sys.version.split()[0],
+            },
+            'elapsed_seconds': round(elapsed, 3),
+            'jobs': {'finished': len(finished), 'succeeded': len(succeeded), 'failed': len(finished) - len(succeeded),
+                     'unfinished': len(users) - len(finished),
+                     'per_second': round(len(succeeded) / elapsed, 3) if elapsed else None},
+            'time_to_first_file': {'p50': percentile(ttff, 0.5), 'p99': percentile(ttff, 0.99),
+                                   'max': round(max(ttff), 4) if ttff else None},
+            'event_loop_lag': {'p50': percentile(self.loop_lag, 0.5), 'p99': percentile(self.loop_lag, 0.99),
+                               'max': round(max(self.loop_lag), 4) if self.loop_lag else None,
+                               'mean': round(statistics.fmean(self.loop_lag), 4) if self.loop_lag else None,
+                               'blocked': dict(loop_monitor.monitor.blocked)},
+            'status_updates': {'calls': status_calls,
+                               'per_second': round(status_calls / elapsed, 3) if elapsed else None,
+                               'per_job': round(status_calls / len(finished), 3) if finished else None},
+            'api_calls': self.api.calls,
+            'retry_after': self.api.retry_after,
+            'uploaded_bytes': self.api.uploaded_bytes,
+            'errors': sorted({user.error for user in finished if user.error}),
+        }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота на фейковом Bot API и синтетических медиа")
+    parser.add_argument('--users', type=int, default=1000, help="количество одновременных пользователей")
+    parser.add_argument('--ramp', type=float, default=30, help="за сколько секунд приходят все пользователи")
+    parser.add_argument('--videos', type=int, default=20, help="количество разных ссылок")
+    parser.add_argument('--duration', type=int, default=30, help="длительность синтетического медиа в секундах")
+    parser.add_argument('--chapters', type=int, default=1, help="количество глав (1 — загрузка целиком)")
+    parser.add_argument('--video', action='store_true', help="скачивать видео вместо аудио")
+    parser.add_argument('--think-time', type=float, default=0.5, help="пауза пользователя между действиями")
+    parser.add_argument('--latency', type=float, default=0.05, help="средняя задержка ответа Bot API")
+    parser.add_argument('--upload-latency', type=float, default=0.3, help="средняя задержка отправки файла")
+    parser.add_argument('--retry-after-probability', type=float, default=0.01, help="доля ответов 429 RetryAfter")
+    parser.add_argument('--rate-limit', type=float, default=30, help="лимит сообщений в секунду (0 — без лимита)")
+    parser.add_argument('--timeout', type=float, default=600, help="максимальная длительность теста")
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--work-dir', type=Path, default=None, help="каталог для синтетических файлов (кэшируется)")
+    parser.add_argument('--output', type=Path, default=None, help="файл для JSON-результатов (по умолчанию stdout)")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(name)s [%(levelname)s] - %(message)s', level=logging.WARNING)
+    logger.setLevel(logging.INFO)
+    random.seed(args.seed)
+
+    if shutil.which('ffmpeg') is None:
+        logger.critical("ffmpeg не найден в PATH")
+        sys.exit(1)
+
+    cleanup_work_dir = args.work_dir is None
+    work_dir = args.work_dir or Path(tempfile.mkdtemp(prefix='video_bot_load_'))
+    try:
+        report = asyncio.run(LoadTest(args, work_dir).run())
+    finally:
+        if cleanup_work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        args.output.write_text(output, encoding='utf-8')
+    else:
+        print(output)
+
+    jobs = report['jobs']
+    if jobs['failed'] or jobs['unfinished']:
+        logger.error(f"Нагрузочный тест не пройден: ошибок {jobs['failed']}, не завершено {jobs['unfinished']}: "
+                     f"{report['errors']}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+LOOP_MONITOR = os.getenv('LOOP_MONITOR', '1') == '1'
+LOOP_LAG_INTERVAL = float(os.getenv('LOOP_LAG_INTERVAL', '0.1'))
+LOOP_BLOCK_THRESHOLD = float(os.getenv('LOOP_BLOCK_THRESHOLD', '0.5'))
+
+BASE_DIR = Path(__file__).resolve().parent
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+loop_lag = metrics.registry.histogram('syntube_event_loop_lag_seconds', 'Задержка тиков цикла событий', LAG_BUCKETS)
+loop_blocked = metrics.registry.counter('syntube_event_loop_blocked_total',
+                                        'Блокировки цикла событий дольше порога по месту в коде')
+
+
+def _blocking_site(stack: List[traceback.FrameSummary]) -> str:
+    own_frames = [frame for frame in stack if Path(frame.filename).resolve().parent == BASE_DIR
+                  and Path(frame.filename).name != Path(__file__).name]
+    frame = (own_frames or stack)[-1]
+    return f"{Path(frame.filename).name}:{frame.lineno} {frame.name}"
+
+
+class LoopMonitor:
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL, threshold: float = LOOP_BLOCK_THRESHOLD):
+        self.interval = interval
+        self.threshold = threshold
+        self.last_tick = time.monotonic()
+        self.lag = 0.0
+        self.max_lag = 0.0
+        self.blocked: Dict[str, int] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: Optional[int] = None
+        self._ticker: Optional[asyncio.Task] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+
+    async def _tick(self):
+        while True:
+            started = self._loop.time()
+            self.last_tick = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.lag = max(0.0, self._loop.time() - started - self.interval)
+            self.max_lag = max(self.max_lag, self.lag)
+            loop_lag.observe(self.lag)
+
+    def _watch(self):
+        reported_tick = None
+        while not self._stopped.wait(self.threshold / 2):
+            tick = self.last_tick
+            stalled = time.monotonic() - tick - self.interval
+            if stalled < self.threshold or tick == reported_tick:
+                continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            reported_tick = tick
+            stack = traceback.extract_stack(frame)
+            site = _blocking_site(stack)
+            self.blocked[site] = self.blocked.get(site, 0) + 1
+            loop_blocked.inc(site=site)
+            logger.warning(f"Цикл событий заблокирован на {stalled:.2f} с в {site}:\n{''.join(stack.format()[-8:])}")
+
+    def start(self):
+        if self._ticker:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._stopped.clear()
+        self.last_tick = time.monotonic()
+        self._ticker = self._loop.create_task(self._tick())
+        self._watchdog = threading.Thread(target=self._watch, name='loop-watchdog', daemon=True)
+        self._watchdog.start()
+        logger.info(f"Мониторинг цикла событий запущен (интервал {self.interval} с, порог {self.threshold} с)")
+
+    async def stop(self):
+        self._stopped.set()
+        if self._ticker:
+            self._ticker.cancel()
+            await asyncio.gather(self._ticker, return_exceptions=True)
+            self._ticker = None
+        if self._watchdog:
+            await asyncio.get_running_loop().run_in_executor(None, self._watchdog.join)
+            self._watchdog = None
+
+
+monitor = LoopMonitor()
+
+metrics.registry.gauge('syntube_event_loop_lag_current_seconds', 'Последняя измеренная задержка цикла событий',
+                       lambda: monitor.lag)
@@ -0,0 +1,314 @@
+import asyncio
+import contextvars
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+SLOW_JOB_SECONDS = float(os.getenv('SLOW_JOB_SECONDS', '0'))
+EXECUTOR_MAX_WORKERS = int(os.getenv('EXECUTOR_MAX_WORKERS', str(min(32, (os.cpu_count() or 1) + 4))))
+DOWNLOAD_EXECUTOR_WORKERS = int(os.getenv('DOWNLOAD_EXECUTOR_WORKERS', '16'))
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def _label_key(labels: Dict[str, object]) -> LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _escape_label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(key: LabelKey, extra: Optional[Tuple[str, str]] = None) -> str:
+    items = list(key) + ([extra] if extra else [])
+    if not items:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape_label(v)}"' for k, v in items) + '}'
+
+
+class Counter:
+    type_name = 'counter'
+
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self._values: Dict[LabelKey, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            return [f"{self.name}{_format_labels(key)} {value}" for key, value in self._values.items()]
+
+
+class Gauge(Counter):
+    type_name = 'gauge'
+
+    def __init__(self, name: str, help_text: str, function: Optional[Callable[[], float]] = None):
+        super().__init__(name, help_text)
+        self.function = function
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[_label_key(labels)] = value
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def samples(self) -> List[str]:
+        if self.function is not None:
+            try:
+                self.set(self.function())
+            except Exception as e:
+                logger.warning(f"Ошибка вычисления метрики {self.name}: {e}")
+        return super().samples()
+
+
+class Histogram:
+    type_name = 'histogram'
+
+    def __init__(self, name: str, help_text: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(sorted(buckets))
+        self._values: Dict[LabelKey, List[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            data = self._values.setdefault(key, [0] * len(self.buckets) + [0, 0.0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data[i] += 1
+            data[-2] += 1
+            data[-1] += value
+
+    def samples(self) -> List[str]:
+        lines = []
+        with self._lock:
+            for key, data in self._values.items():
+                for i, bound in enumerate(self.buckets):
+                    lines.append(f"{self.name}_bucket{_format_labels(key, ('le', str(bound)))} {data[i]}")
+                lines.append(f"{self.name}_bucket{_format_labels(key, ('le', '+Inf'))} {data[-2]}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {data[-2]}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {data[-1]}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+
+    def _register(self, metric):
+        return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, help_text: str) -> Counter:
+        return self._register(Counter(name, help_text))
+
+    def gauge(self, name: str, help_text: str, function: Optional[Callable[[], float]] = None) -> Gauge:
+        return self._register(Gauge(name, help_text, function))
+
+    def histogram(self, name: str, help_text: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help_text, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.type_name}")
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+stage_duration = registry.histogram('syntube_stage_duration_seconds', 'Длительность стадий обработки')
+stage_bytes = registry.counter('syntube_stage_bytes_total', 'Байты, обработанные стадиями')
+job_duration = registry.histogram('syntube_job_duration_seconds', 'Полная длительность задач')
+jobs_total = registry.counter('syntube_jobs_total', 'Завершённые задачи по результату')
+time_to_first_file = registry.histogram('syntube_time_to_first_file_seconds', 'Время от начала задачи до первого файла')
+jobs_in_flight = registry.gauge('syntube_jobs_in_flight', 'Задачи в обработке')
+telegram_retry_after = registry.counter('syntube_telegram_retry_after_total', 'Ответы Telegram 429 (RetryAfter)')
+
+
+class InstrumentedThreadPoolExecutor(ThreadPoolExecutor):
+    def __init__(self, max_workers: Optional[int] = None, **kwargs):
+        super().__init__(max_workers=max_workers, **kwargs)
+        self.pending = 0
+        self.active = 0
+        self._counter_lock = threading.Lock()
+
+    def submit(self, fn, /, *args, **kwargs):
+        with self._counter_lock:
+            self.pending += 1
+
+        def run():
+            with self._counter_lock:
+                self.pending -= 1
+                self.active += 1
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._counter_lock:
+                    self.active -= 1
+
+        return super().submit(run)
+
+
+executor = InstrumentedThreadPoolExecutor(max_workers=EXECUTOR_MAX_WORKERS, thread_name_prefix='syntube')
+
+registry.gauge('syntube_executor_queue_depth', 'Задачи, ожидающие потока исполнителя', lambda: executor.pending)
+registry.gauge('syntube_executor_active', 'Занятые потоки исполнителя', lambda: executor.active)
+registry.gauge('syntube_executor_saturation', 'Доля занятых потоков исполнителя',
+               lambda: executor.active / executor._max_workers)
+
+download_executor = InstrumentedThreadPoolExecutor(max_workers=DOWNLOAD_EXECUTOR_WORKERS,
+                                                   thread_name_prefix='syntube-download')
+
+registry.gauge('syntube_download_executor_queue_depth', 'Загрузки и запросы к источникам, ожидающие потока',
+               lambda: download_executor.pending)
+registry.gauge('syntube_download_executor_active', 'Занятые потоки исполнителя загрузок',
+               lambda: download_executor.active)
+
+
+class Span:
+    def __init__(self, name: str, parent: Optional['Span'] = None, **attrs):
+        self.name = name
+        self.parent = parent
+        self.attrs = attrs
+        self.children: List['Span'] = []
+        self.start = time.perf_counter()
+        self.end: Optional[float] = None
+        self.error: Optional[str] = None
+
+    @property
+    def duration(self) -> float:
+        return (self.end or time.perf_counter()) - self.start
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def add_bytes(self, amount: int):
+        self.attrs['bytes'] = self.attrs.get('bytes', 0) + amount
+
+    def format_tree(self, indent: int = 0) -> str:
+        attrs = ' '.join(f"{k}={v}" for k, v in self.attrs.items())
+        status = f" ОШИБКА: {self.error}" if self.error else ''
+        lines = [f"{'  ' * indent}{self.name} {self.duration:.3f}s {attrs}{status}".rstrip()]
+        for child in self.children:
+            lines.append(child.format_tree(indent + 1))
+        return '\n'.join(lines)
+
+
+_current_span: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar('current_span', default=None)
+
+
+@contextmanager
+def span(name: str, **attrs):
+    parent = _current_span.get()
+    current = Span(name, parent, **attrs)
+    if parent is not None:
+        parent.children.append(current)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = type(e).__name__
+        raise
+    finally:
+        current.end = time.perf_counter()
+        _current_span.reset(token)
+        stage_duration.observe(current.duration, stage=name)
+        if 'bytes' in current.attrs:
+            stage_bytes.inc(current.attrs['bytes'], stage=name)
+
+
+@contextmanager
+def job_span(kind: str, **attrs):
+    jobs_in_flight.inc()
+    result = 'ok'
+    root = Span(kind, None, **attrs)
+    token = _current_span.set(root)
+    try:
+        yield root
+    except asyncio.CancelledError:
+        result = 'cancelled'
+        raise
+    except BaseException as e:
+        result = 'error'
+        root.error = type(e).__name__
+        raise
+    finally:
+        root.end = time.perf_counter()
+        _current_span.reset(token)
+        jobs_in_flight.dec()
+        jobs_total.inc(kind=kind, result=result)
+        job_duration.observe(root.duration, kind=kind)
+        if SLOW_JOB_SECONDS and root.duration >= SLOW_JOB_SECONDS:
+            logger.warning(f"Медленная задача ({root.duration:.1f}s):\n{root.format_tree()}")
+
+
+def mark_file_delivered():
+    root = _current_span.get()
+    while root is not None and root.parent is not None:
+        root = root.parent
+    if root is not None and 'first_file_s' not in root.attrs:
+        root.attrs['first_file_s'] = round(root.duration, 3)
+        time_to_first_file.observe(root.duration, kind=root.name)
+
+
+def count_retry_after(method: str):
+    telegram_retry_after.inc(method=method)
+
+
+class MetricsServer:
+    def __init__(self, host: str = METRICS_HOST, port: int = METRICS_PORT):
+        self.host = host
+        self.port = port
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request_line.decode('latin-1').split()
+            path = parts[1] if len(parts) > 1 else '/'
+            if path.split('?')[0] == '/metrics':
+                status, body = '200 OK', registry.render().encode()
+            else:
+                status, body = '404 Not Found', b'not found\n'
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        logger.info(f"Метрики доступны на http://{self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
@@ -0,0 +1,370 @@
+import asyncio
+import logging
+import os
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from telegram import InputFile
+
+import db
+import keyframes
+import metrics
+import storage
+import task_queue
+import utils
+from playlist import PLAYLIST_WORKERS, PlaylistPipeline
+from video_processor import VideoProcessor
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_BUFFER = int(os.getenv('SEGMENT_BUFFER', '2'))
+STREAM_AUDIO_TRANSCODE = os.getenv('STREAM_AUDIO_TRANSCODE', '1') == '1'
+BATCH_WORKERS = int(os.getenv('BATCH_WORKERS', str(PLAYLIST_WORKERS)))
+UPLOAD_PAUSE = float(os.getenv('UPLOAD_PAUSE', '1'))
+UPLOAD_PREREAD_MB = float(os.getenv('UPLOAD_PREREAD_MB', '50'))
+
+Report = Callable[[str], Awaitable[None]]
+
+
+class JobCheckpoint:
+    def __init__(self, job_id: Optional[int] = None, stage: Optional[str] = None,
+                 data: Optional[Dict[str, Any]] = None, queue: Optional[task_queue.JobQueue] = None):
+        self.job_id = job_id
+        self.stage = stage
+        self.data = dict(data or {})
+        self.queue = queue or task_queue.local_queue
+        self.cancelled = False
+        self.reservation: Optional[storage.Reservation] = None
+
+    @classmethod
+    def from_job(cls, job: Dict[str, Any], queue: Optional[task_queue.JobQueue] = None) -> 'JobCheckpoint':
+        return cls(job['job_id'], job.get('stage'), job.get('checkpoint'), queue)
+
+    @property
+    def persistent(self) -> bool:
+        return self.job_id is not None
+
+    @property
+    def dir_name(self) -> Optional[str]:
+        return storage.job_dir_name(self.job_id) if self.persistent else None
+
+    async def save(self, stage: str, **data):
+        self.stage = stage
+        self.data.update(data)
+        if self.persistent:
+            await asyncio.get_running_loop().run_in_executor(
+                None, self.queue.checkpoint, self.job_id, stage, self.data)
+
+
+def sweep_job_dirs(max_age: float = storage.ORPHAN_MAX_AGE, queue: Optional[task_queue.JobQueue] = None) -> int:
+    keyframes.prune_cache()
+    keep = {storage.job_dir_name(job['job_id']) for job in (queue or task_queue.local_queue).unfinished()}
+    return storage.storage_manager.sweep_orphans(max_age, keep)
+
+
+def build_job(user_id: int, state: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        'user_id': user_id,
+        'url': state['url'],
+        'is_video': state['is_video'],
+        'by_timestamps': state['by_timestamps'],
+        'is_playlist': state.get('is_playlist', False),
+        'urls': state.get('urls'),
+        'duration': state.get('duration'),
+        'source_message_id': state.get('source_message_id'),
+    }
+
+
+def get_audio_metadata(file_path):
+    try:
+        from mutagen.mp3 import MP3
+
+        audio = MP3(str(file_path))
+        if audio.tags:
+            title = str(audio.tags.get('TIT2', ['Unknown'])[0]) if audio.tags.get('TIT2') else 'Unknown'
+            artist = str(audio.tags.get('TPE1', ['Unknown'])[0]) if audio.tags.get('TPE1') else 'Unknown'
+            duration = int(audio.info.length) if audio.info.length else 0
+            return title, artist, duration
+    except Exception as e:
+        logger.warning(f"Ошибка чтения метаданных из {file_path}: {e}")
+
+    return 'Unknown', 'Unknown', 0
+
+
+def read_thumbnail(thumbnail_path: Path | None) -> bytes | None:
+    return thumbnail_path.read_bytes() if thumbnail_path and thumbnail_path.exists() else None
+
+
+async def send_media_file(bot, user_id: int, file_path: Path, is_video: bool,
+                          thumbnail_path: Path | None = None, reply_to_message_id: int | None = None):
+    loop = asyncio.get_running_loop()
+    file_size = (await loop.run_in_executor(None, file_path.stat)).st_size
+    logger.info(f"Отправка файла {file_path.name} размером {file_size / (1024 * 1024):.1f} МБ")
+
+    if is_video:
+        send, field, options = bot.send_video, 'video', {'caption': f"🎬 {file_path.stem}"}
+    else:
+        title, artist, duration = await loop.run_in_executor(None, get_audio_metadata, file_path)
+        logger.info(f"Метаданные для {file_path.name}: title='{title}', artist='{artist}', duration={duration}")
+        thumbnail = await loop.run_in_executor(None, read_thumbnail, thumbnail_path)
+        send, field, options = bot.send_audio, 'audio', {'title': title, 'performer': artist,
+                                                         'duration': duration, 'thumbnail': thumbnail}
+
+    async def upload():
+        if file_size <= UPLOAD_PREREAD_MB * 1024 * 1024:
+            handle = None
+            content = InputFile(await loop.run_in_executor(None, file_path.read_bytes), filename=file_path.name)
+        else:
+            handle = await loop.run_in_executor(None, file_path.open, 'rb')
+            content = InputFile(handle, filename=file_path.name, read_file_handle=False)
+        try:
+            with metrics.span('upload', file=file_path.name, bytes=file_size):
+                await send(chat_id=user_id, reply_to_message_id=reply_to_message_id, **{field: content}, **options)
+        finally:
+            if handle:
+                handle.close()
+
+    await utils.call_with_retry(upload, 'upload')
+    metrics.mark_file_delivered()
+
+
+async def split_and_upload(bot, user_id: int, processor: VideoProcessor, source_file: Path,
+                           timestamps: list, is_video: bool, reply_to_message_id: int | None, report: Report,
+                           checkpoint: Optional[JobCheckpoint] = None):
+    checkpoint = checkpoint or JobCheckpoint()
+    uploaded = set(checkpoint.data.get('uploaded', []))
+    if uploaded:
+        logger.info(f"Пропуск {len(uploaded)} уже отправленных сегментов для user {user_id}")
+    segments: asyncio.Queue = asyncio.Queue(maxsize=SEGMENT_BUFFER)
+
+    async def produce():
+        try:
+            async for item in processor.iter_split_segments(source_file, timestamps, is_video, skip=uploaded):
+                await segments.put(item)
+        except Exception as e:
+            await segments.put(e)
+            return
+        await segments.put(None)
+
+    producer = asyncio.create_task(produce())
+    try:
+        while (item := await segments.get()) is not None:
+            if isinstance(item, Exception):
+                raise item
+            index, segment_path = item
+            await send_media_file(bot, user_id, segment_path, is_video,
+                                  processor.thumbnail_path, reply_to_message_id)
+            await asyncio.get_running_loop().run_in_executor(None, segment_path.unlink, True)
+            uploaded.add(index)
+            await checkpoint.save('uploading', uploaded=sorted(uploaded))
+            await report(processor.create_progress_bar(50 + len(uploaded) * 50 // len(timestamps)))
+            await asyncio.sleep(UPLOAD_PAUSE)
+    finally:
+        if not producer.done():
+            producer.cancel()
+        await asyncio.gather(producer, return_exceptions=True)
+    await asyncio.get_running_loop().run_in_executor(None, source_file.unlink, True)
+    logger.info(f"Отправлено {len(uploaded)} сегментов для user {user_id}")
+
+
+async def run_playlist(job: Dict[str, Any], bot, report: Report, checkpoint: JobCheckpoint):
+    user_id = job['user_id']
+    is_video = job['is_video']
+    urls = job.get('urls')
+    label = "📦 Пакет" if urls else "📃 Плейлист"
+    uploaded = set(checkpoint.data.get('uploaded', []))
+    if uploaded:
+        logger.info(f"Возобновление задачи {checkpoint.job_id}: пропуск {len(uploaded)} отправленных видео")
+
+    async def upload(processor: VideoProcessor, file_path: Path):
+        await send_media_file(bot, user_id, file_path, is_video,
+                              processor.thumbnail_path, job['source_message_id'])
+        await asyncio.sleep(UPLOAD_PAUSE)
+
+    async def on_entry_done(index: int):
+        uploaded.add(index)
+        await checkpoint.save('uploading', uploaded=sorted(uploaded))
+
+    async def on_progress(done: int, failed: int, total: int | None):
+        failed_text = f", ошибок: {failed}" if failed else ""
+        await report(f"{label}: готово {done} из {total or '?'}{failed_text}")
+
+    await report(f"{label}: подготовка...")
+    pipeline = PlaylistPipeline(job['url'], is_video, job['by_timestamps'], storage.storage_manager, upload,
+                                on_progress, processor_factory=VideoProcessor,
+                                workers=BATCH_WORKERS if urls else PLAYLIST_WORKERS,
+                                stream_transcode=STREAM_AUDIO_TRANSCODE,
+                                skip=uploaded, on_entry_done=on_entry_done, urls=urls)
+    result = await pipeline.run()
+    logger.info(f"{'Пакет ссылок' if urls else 'Плейлист'} для user {user_id} обработан: {result}")
+
+
+async def resolve_info(processor: VideoProcessor, job: Dict[str, Any], checkpoint: JobCheckpoint,
+                       report: Report, notice_delay: float = 3) -> Tuple[Dict[str, Any], list, bool]:
+    url = job['url']
+    by_timestamps = job['by_timestamps']
+    with metrics.span('extract_info'):
+        video_info = await processor.get_video_info(url, cache=checkpoint.persistent)
+    if not video_info:
+        raise ValueError("Не удалось получить информацию о видео.")
+    if VideoProcessor.is_playlist(video_info):
+        raise ValueError("Ссылка ведёт на плейлист, а не на отдельное видео.")
+
+    if checkpoint.stage:
+        timestamps = [tuple(item) for item in checkpoint.data.get('timestamps', [])]
+        return video_info, timestamps, checkpoint.data.get('by_timestamps', by_timestamps)
+
+    timestamps = []
+    if by_timestamps:
+        await report("📝 Поиск таймкодов...")
+
+        with metrics.span('comments') as comments_span:
+            comments = await processor.get_video_comments(url)
+            comments_span.set(count=len(comments))
+        with metrics.span('timestamps') as timestamps_span:
+            timestamps = processor.get_all_timestamps(url)
+            timestamps_span.set(count=len(timestamps))
+
+        if not timestamps:
+            await report("ℹ️ Таймкоды не найдены, загружаю целиком.")
+            await asyncio.sleep(notice_delay)
+            by_timestamps = False
+        else:
+            logger.info(f"Найдено {len(timestamps)} временных меток")
+    await checkpoint.save('info', timestamps=timestamps, by_timestamps=by_timestamps)
+    return video_info, timestamps, by_timestamps
+
+
+async def ensure_download(processor: VideoProcessor, job: Dict[str, Any], checkpoint: JobCheckpoint,
+                          report: Report) -> Path:
+    loop = asyncio.get_running_loop()
+    if checkpoint.data.get('downloaded_file'):
+        downloaded_file = processor.temp_dir / checkpoint.data['downloaded_file']
+        if await loop.run_in_executor(None, downloaded_file.exists):
+            return downloaded_file
+
+    resumed_download = checkpoint.stage == 'downloading'
+    await checkpoint.save('downloading')
+    await report(processor.create_progress_bar(0))
+    with metrics.span('download') as download_span:
+        downloaded_file = await processor.download_media(
+            job['url'], job['is_video'],
+            progress_callback=lambda percent: report(processor.create_progress_bar(int(percent) // 10 * 10)),
+            stream_transcode=STREAM_AUDIO_TRANSCODE and not resumed_download)
+        download_span.add_bytes((await loop.run_in_executor(None, downloaded_file.stat)).st_size)
+    await checkpoint.save('downloaded', downloaded_file=downloaded_file.name)
+    return downloaded_file
+
+
+async def prefetch(job: Dict[str, Any], checkpoint: JobCheckpoint,
+                   on_evict: Optional[Callable[[], Awaitable[None]]] = None) -> Optional[storage.Reservation]:
+    async def silent(text: str):
+        pass
+
+    reservation = None
+    processor = None
+    completed = False
+    try:
+        reservation = await storage.storage_manager.reserve(
+            storage.estimate_job_bytes({'duration': job.get('duration')}, job['is_video'], job['by_timestamps']),
+            timeout=0, name=checkpoint.dir_name, on_evict=on_evict)
+        processor = VideoProcessor(temp_dir=str(reservation.path))
+        with metrics.job_span('prefetch', user_id=job['user_id'], is_video=job['is_video']):
+            video_info, _, _ = await resolve_info(processor, job, checkpoint, silent, notice_delay=0)
+            await reservation.resize(storage.estimate_job_bytes(video_info, job['is_video'], job['by_timestamps']),
+                                     timeout=0)
+            processor.temp_dir = reservation.path
+            if not job['is_video']:
+                await ensure_download(processor, job, checkpoint, silent)
+        completed = True
+        logger.info(f"Спекулятивная подготовка задачи {checkpoint.job_id} завершена на этапе '{checkpoint.stage}'")
+        return reservation
+    except asyncio.CancelledError:
+        logger.info(f"Спекулятивная подготовка задачи {checkpoint.job_id} отменена")
+        raise
+    except Exception as e:
+        logger.info(f"Спекулятивная подготовка задачи {checkpoint.job_id} не удалась: {e}")
+        return None
+    finally:
+        if not completed:
+            if processor:
+                await processor.cleanup()
+            if reservation:
+                await reservation.release()
+
+
+async def run_video(job: Dict[str, Any], bot, report: Report, checkpoint: JobCheckpoint):
+    user_id = job['user_id']
+    url = job['url']
+    is_video = job['is_video']
+    source_message_id = job['source_message_id']
+    if checkpoint.stage == 'uploaded':
+        logger.info(f"Задача {checkpoint.job_id} уже отправлена, возобновлять нечего")
+        return
+
+    processor = None
+    reservation = None
+    keep_files = False
+
+    try:
+        reservation = checkpoint.reservation or await storage.storage_manager.reserve(
+            storage.estimate_job_bytes({'duration': job.get('duration')}, is_video, job['by_timestamps']),
+            on_wait=lambda: report("⏳ Ожидание свободного места..."),
+            name=checkpoint.dir_name
+        )
+        processor = VideoProcessor(temp_dir=str(reservation.path))
+        if checkpoint.stage:
+            logger.info(f"Возобновление задачи {checkpoint.job_id} с этапа '{checkpoint.stage}'")
+            await report("♻️ Продолжаю с сохранённого этапа...")
+
+        await report("🔍 Анализ ссылки...")
+        video_info, timestamps, by_timestamps = await resolve_info(processor, job, checkpoint, report)
+        await reservation.resize(storage.estimate_job_bytes(video_info, is_video, by_timestamps))
+        processor.temp_dir = reservation.path
+
+        downloaded_file = await ensure_download(processor, job, checkpoint, report)
+
+        if not is_video:
+            with metrics.span('thumbnail'):
+                await processor.download_thumbnail(url)
+
+        await report(processor.create_progress_bar(50))
+
+        if by_timestamps and timestamps:
+            await split_and_upload(bot, user_id, processor, downloaded_file, timestamps,
+                                   is_video, source_message_id, report, checkpoint)
+        else:
+            if not is_video:
+                video_title = video_info.get('title', 'Unknown Video')
+                with metrics.span('tag'):
+                    await processor.add_metadata_to_audio(
+                        file_path=downloaded_file,
+                        title="Full",
+                        artist=video_title
+                    )
+                logger.info(f"Добавлены метаданные для полного трека: title='Full', artist='{video_title}'")
+
+            await report(processor.create_progress_bar(80))
+            await send_media_file(bot, user_id, downloaded_file, is_video,
+                                  processor.thumbnail_path, source_message_id)
+        await checkpoint.save('uploaded')
+    except asyncio.CancelledError:
+        keep_files = checkpoint.persistent and not checkpoint.cancelled
+        raise
+    finally:
+        if processor and not keep_files:
+            await processor.cleanup()
+        if reservation:
+            await reservation.release(keep_files)
+
+
+async def run_job(job: Dict[str, Any], bot, report: Report, checkpoint: Optional[JobCheckpoint] = None):
+    checkpoint = checkpoint or JobCheckpoint()
+    if job.get('is_playlist') or job.get('urls'):
+        kind = 'batch' if job.get('urls') else 'playlist'
+        with metrics.job_span(kind, user_id=job['user_id'], is_video=job['is_video']):
+            await run_playlist(job, bot, report, checkpoint)
+    else:
+        with metrics.job_span('job', user_id=job['user_id'], is_video=job['is_video'],
+                              by_timestamps=job['by_timestamps']):
+            await run_video(job, bot, report, checkpoint)
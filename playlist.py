@@ -0,0 +1,213 @@
+import asyncio
+import logging
+import os
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Collection, Dict, List, Optional
+
+import metrics
+from storage import StorageManager, Reservation, estimate_job_bytes
+from video_processor import VideoProcessor
+
+logger = logging.getLogger(__name__)
+
+PLAYLIST_WORKERS = int(os.getenv('PLAYLIST_WORKERS', '2'))
+PLAYLIST_BUFFER = int(os.getenv('PLAYLIST_BUFFER', '2'))
+
+_DONE = object()
+
+
+class PlaylistEntryResult:
+    def __init__(self, index: int, url: str, processor: VideoProcessor, reservation: Reservation, files: List[Path]):
+        self.index = index
+        self.url = url
+        self.processor = processor
+        self.reservation = reservation
+        self.files = files
+
+    async def cleanup(self):
+        await self.processor.cleanup()
+        await self.reservation.release()
+
+
+class PlaylistPipeline:
+    def __init__(self, url: Optional[str], is_video: bool, by_timestamps: bool, storage: StorageManager,
+                 upload: Callable[[VideoProcessor, Path], Awaitable[None]],
+                 on_progress: Optional[Callable[[int, int, Optional[int]], Awaitable[None]]] = None,
+                 processor_factory: Callable[..., VideoProcessor] = VideoProcessor,
+                 workers: int = PLAYLIST_WORKERS, buffer: int = PLAYLIST_BUFFER,
+                 stream_transcode: bool = False, skip: Collection[int] = (),
+                 on_entry_done: Optional[Callable[[int], Awaitable[None]]] = None,
+                 urls: Optional[List[str]] = None):
+        self.url = url
+        self.urls = urls
+        self.is_video = is_video
+        self.by_timestamps = by_timestamps
+        self.storage = storage
+        self.upload = upload
+        self.on_progress = on_progress
+        self.processor_factory = processor_factory
+        self.stream_transcode = stream_transcode
+        self.skip = set(skip)
+        self.on_entry_done = on_entry_done
+        self.workers = max(1, workers)
+        self.entries: asyncio.Queue = asyncio.Queue(maxsize=max(1, buffer))
+        self.ready: asyncio.Queue = asyncio.Queue(maxsize=max(1, buffer))
+        self.slots = asyncio.Semaphore(self.workers + max(1, buffer))
+        self.pending: Dict[int, Optional[PlaylistEntryResult]] = {}
+        self.total: Optional[int] = None
+        self.done = len(self.skip)
+        self.failed = 0
+
+    async def _report(self):
+        if self.on_progress:
+            await self.on_progress(self.done, self.failed, self.total)
+
+    async def _produce(self):
+        if self.urls is not None:
+            await self._produce_urls()
+            return
+        listing = self.processor_factory()
+        try:
+            index = 0
+            async for entry in listing.iter_playlist_entries(self.url):
+                entry_url = entry.get('webpage_url') or entry.get('url')
+                if not entry_url or not str(entry_url).startswith('http'):
+                    logger.warning(f"Пропущен элемент плейлиста без ссылки: {entry.get('id')}")
+                    continue
+                index += 1
+                if index in self.skip:
+                    continue
+                await self.entries.put((index, entry_url, entry))
+            self.total = index
+            logger.info(f"Плейлист {self.url}: найдено {index} элементов")
+        finally:
+            await listing.cleanup()
+        for _ in range(self.workers):
+            await self.entries.put(_DONE)
+
+    async def _produce_urls(self):
+        self.total = len(self.urls)
+        for index, url in enumerate(self.urls, start=1):
+            if index not in self.skip:
+                await self.entries.put((index, url, {'webpage_url': url}))
+        for _ in range(self.workers):
+            await self.entries.put(_DONE)
+
+    async def _prepare_entry(self, index: int, url: str, entry: Dict[str, Any]) -> PlaylistEntryResult:
+        loop = asyncio.get_running_loop()
+        reservation = await self.storage.reserve(estimate_job_bytes(entry, self.is_video, self.by_timestamps))
+        processor = self.processor_factory(temp_dir=str(reservation.path))
+        try:
+            with metrics.span('playlist_entry', index=index):
+                with metrics.span('extract_info'):
+                    info = await processor.get_video_info(url)
+                if processor.is_playlist(info):
+                    raise ValueError("вложенные плейлисты не поддерживаются")
+                await reservation.resize(estimate_job_bytes(info, self.is_video, self.by_timestamps))
+                processor.temp_dir = reservation.path
+
+                timestamps = []
+                if self.by_timestamps:
+                    with metrics.span('timestamps') as timestamps_span:
+                        timestamps = processor.get_all_timestamps(url)
+                        timestamps_span.set(count=len(timestamps))
+
+                with metrics.span('download') as download_span:
+                    downloaded_file = await processor.download_media(url, self.is_video,
+                                                                     stream_transcode=self.stream_transcode)
+                    download_span.add_bytes((await loop.run_in_executor(None, downloaded_file.stat)).st_size)
+
+                if not self.is_video:
+                    with metrics.span('thumbnail'):
+                        await processor.download_thumbnail(url)
+
+                if timestamps:
+                    files = await processor.split_media(downloaded_file, timestamps, self.is_video)
+                    await loop.run_in_executor(None, downloaded_file.unlink, True)
+                else:
+                    files = [downloaded_file]
+                    if not self.is_video:
+                        with metrics.span('tag'):
+                            await processor.add_metadata_to_audio(
+                                file_path=downloaded_file,
+                                title=info.get('title', 'Unknown Track'),
+                                artist=info.get('uploader') or info.get('channel') or 'Unknown'
+                            )
+            return PlaylistEntryResult(index, url, processor, reservation, files)
+        except BaseException:
+            await processor.cleanup()
+            await reservation.release()
+            raise
+
+    async def _work(self):
+        while True:
+            await self.slots.acquire()
+            item = await self.entries.get()
+            if item is _DONE:
+                self.slots.release()
+                break
+            index, url, entry = item
+            try:
+                result = await self._prepare_entry(index, url, entry)
+            except Exception as e:
+                logger.error(f"Ошибка обработки элемента плейлиста #{index} ({url}): {e}")
+                self.failed += 1
+                await self._report()
+                result = None
+            await self.ready.put((index, result))
+
+    async def _upload_entry(self, result: PlaylistEntryResult):
+        try:
+            for file_path in result.files:
+                await self.upload(result.processor, file_path)
+            self.done += 1
+            if self.on_entry_done:
+                await self.on_entry_done(result.index)
+        except Exception as e:
+            logger.error(f"Ошибка отправки элемента плейлиста #{result.index} ({result.url}): {e}")
+            self.failed += 1
+        finally:
+            await result.cleanup()
+        await self._report()
+
+    async def _upload_all(self):
+        next_index = 1
+        while True:
+            item = await self.ready.get()
+            if item is _DONE:
+                break
+            index, result = item
+            self.pending[index] = result
+            while True:
+                while next_index in self.skip:
+                    next_index += 1
+                if next_index not in self.pending:
+                    break
+                result = self.pending.pop(next_index)
+                next_index += 1
+                if result:
+                    await self._upload_entry(result)
+                self.slots.release()
+
+    async def run(self) -> Dict[str, Any]:
+        uploader = asyncio.create_task(self._upload_all())
+        producer = asyncio.create_task(self._produce())
+        workers = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+        try:
+            await asyncio.gather(producer, *workers)
+            await self.ready.put(_DONE)
+            await uploader
+        except BaseException:
+            for task in [producer, uploader, *workers]:
+                task.cancel()
+            await asyncio.gather(producer, uploader, *workers, return_exceptions=True)
+            results = list(self.pending.values())
+            while not self.ready.empty():
+                item = self.ready.get_nowait()
+                if item is not _DONE:
+                    results.append(item[1])
+            for result in results:
+                if result:
+                    await result.cleanup()
+            raise
+        return {'total': self.total, 'done': self.done, 'failed': self.failed}
@@ -0,0 +1,87 @@
+import asyncio
+import logging
+import os
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Coroutine, Dict, Optional
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+MAX_CONCURRENT_JOBS = int(os.getenv('MAX_CONCURRENT_JOBS', '0'))
+
+
+class JobScheduler:
+    def __init__(self, max_jobs: int = MAX_CONCURRENT_JOBS):
+        self.max_jobs = max(0, max_jobs)
+        self.running = 0
+        self.waiting = 0
+        self.speculative: Dict[asyncio.Task, float] = {}
+        self._condition: Optional[asyncio.Condition] = None
+
+    @property
+    def condition(self) -> asyncio.Condition:
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    @property
+    def busy(self) -> int:
+        return self.running + len(self.speculative)
+
+    def _has_room(self) -> bool:
+        return not self.max_jobs or self.busy < self.max_jobs
+
+    def _preempt(self):
+        active = [task for task in self.speculative if not task.cancelling()]
+        if active:
+            victim = min(active, key=self.speculative.get)
+            logger.info(f"Спекулятивная задача {victim.get_name()} отменена ради подтверждённой")
+            victim.cancel()
+
+    @asynccontextmanager
+    async def job_slot(self, on_wait: Optional[Callable[[], Awaitable[None]]] = None):
+        async with self.condition:
+            self.waiting += 1
+            try:
+                if not self._has_room():
+                    self._preempt()
+                    if on_wait:
+                        await on_wait()
+                await self.condition.wait_for(self._has_room)
+            finally:
+                self.waiting -= 1
+            self.running += 1
+        try:
+            yield
+        finally:
+            self.running -= 1
+            await self._notify()
+
+    def start_speculative(self, coro: Coroutine, name: str) -> Optional[asyncio.Task]:
+        if self.waiting or not self._has_room():
+            coro.close()
+            logger.info(f"Нет свободных слотов для спекулятивной задачи {name}")
+            return None
+        task = asyncio.create_task(coro, name=name)
+        self.speculative[task] = asyncio.get_running_loop().time()
+        task.add_done_callback(self._speculative_done)
+        return task
+
+    def _speculative_done(self, task: asyncio.Task):
+        self.speculative.pop(task, None)
+        asyncio.get_running_loop().create_task(self._notify())
+
+    async def _notify(self):
+        async with self.condition:
+            self.condition.notify_all()
+
+
+scheduler = JobScheduler()
+
+metrics.registry.gauge('syntube_scheduler_running_jobs', 'Подтверждённые задачи, занимающие слот',
+                       lambda: scheduler.running)
+metrics.registry.gauge('syntube_scheduler_speculative_jobs', 'Спекулятивные задачи, занимающие слот',
+                       lambda: len(scheduler.speculative))
+metrics.registry.gauge('syntube_scheduler_waiting_jobs', 'Подтверждённые задачи в ожидании слота',
+                       lambda: scheduler.waiting)
@@ -0,0 +1,63 @@
+import json
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+
+import lazy_imports
+
+BASE_DIR = Path(__file__).resolve().parent
+
+
+def profile_imports(module: str = 'bot', top: int = 25, max_depth: int = 1) -> List[Tuple[str, float, float]]:
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=BASE_DIR, capture_output=True, text=True
+    )
+    timings = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|', 2)
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth <= max_depth:
+            timings.append((name.strip(), int(self_us) / 1e6, int(cumulative_us) / 1e6))
+    timings.sort(key=lambda item: item[2], reverse=True)
+    return timings[:top]
+
+
+def profile_steps(steps: List[Tuple[str, Callable[[], object]]]) -> List[Tuple[str, float]]:
+    timings = []
+    for name, step in steps:
+        started = time.perf_counter()
+        step()
+        timings.append((name, time.perf_counter() - started))
+    return timings
+
+
+def run(init_steps: List[Tuple[str, Callable[[], object]]], as_json: bool = False) -> Dict[str, object]:
+    imports = profile_imports()
+    steps = profile_steps(init_steps)
+    lazy_imports.prewarm()
+    report = {
+        'imports': [{'module': name, 'self_s': self_s, 'cumulative_s': cumulative_s}
+                    for name, self_s, cumulative_s in imports],
+        'init': [{'step': name, 'seconds': seconds} for name, seconds in steps],
+        'lazy_modules': [{'module': name, 'seconds': seconds} for name, seconds in lazy_imports.import_timings.items()],
+    }
+
+    if as_json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        return report
+
+    print("Импорт модулей при запуске (два верхних уровня, по суммарному времени):")
+    for name, self_s, cumulative_s in imports:
+        print(f"  {name:<32} {cumulative_s * 1000:9.1f} ms  (собственное {self_s * 1000:.1f} ms)")
+    print("Инициализация:")
+    for name, seconds in steps:
+        print(f"  {name:<32} {seconds * 1000:9.1f} ms")
+    print("Отложенные модули (загрузка при первом использовании):")
+    for name, seconds in lazy_imports.import_timings.items():
+        print(f"  {name:<32} {seconds * 1000:9.1f} ms")
+    return report
@@ -2,6 +2,7 @@ import time
 import asyncio
 import logging
 import telegram.error
+import utils
 from typing import Optional, Callable
 
 logger = logging.getLogger(__name__)
@@ -15,7 +16,8 @@ class ProgressManager:
         self.last_progress = {}
         self.update_locks = {}
 
-    async def update_status_message(self, user_id: int, bot, text: str, pin: bool = True, force: bool = False):
+    async def update_status_message(self, user_id: int, bot, text: str, pin: bool = True, force: bool = False,
+                                    reply_markup=None):
         current_time = time.time()
 
         if user_id not in self.update_locks:
@@ -39,7 +41,8 @@ class ProgressManager:
                         self.last_progress[user_id] = current_progress
 
             import db
-            settings = db.get_user_settings(user_id)
+            loop = asyncio.get_running_loop()
+            settings = await loop.run_in_executor(None, db.get_user_settings, user_id)
             if not settings:
                 logger.error(f"Не удалось обновить статус для user {user_id}: пользователь не найден в БД.")
                 return
@@ -49,16 +52,12 @@ class ProgressManager:
 
             if message_id:
                 try:
-                    await bot.edit_message_text(chat_id=user_id, message_id=message_id, text=text)
+                    await utils.call_with_retry(lambda: bot.edit_message_text(
+                        chat_id=user_id, message_id=message_id, text=text, reply_markup=reply_markup),
+                        'edit_message_text', retries=1)
                     edit_successful = True
                 except telegram.error.RetryAfter as e:
-                    logger.warning(f"FloodWait для user {user_id}, ожидание {e.retry_after} секунд")
-                    await asyncio.sleep(e.retry_after)
-                    try:
-                        await bot.edit_message_text(chat_id=user_id, message_id=message_id, text=text)
-                        edit_successful = True
-                    except telegram.error.TelegramError as retry_e:
-                        logger.error(f"Повторная ошибка при редактировании для user {user_id}: {retry_e}")
+                    logger.error(f"Повторная ошибка при редактировании для user {user_id}: {e}")
                 except telegram.error.BadRequest as e:
                     if "message is not modified" in str(e).lower():
                         edit_successful = True
@@ -71,20 +70,11 @@ class ProgressManager:
 
             if not edit_successful:
                 try:
-                    sent_message = await bot.send_message(chat_id=user_id, text=text)
+                    sent_message = await utils.call_with_retry(lambda: bot.send_message(
+                        chat_id=user_id, text=text, reply_markup=reply_markup), 'send_message', retries=1)
                     message_id = sent_message.message_id
-                    db.update_user_status_message_id(user_id, message_id)
+                    await loop.run_in_executor(None, db.update_user_status_message_id, user_id, message_id)
                     logger.info(f"Создано новое статусное сообщение {message_id} для user {user_id}")
-                except telegram.error.RetryAfter as e:
-                    logger.warning(f"FloodWait при отправке нового сообщения для user {user_id}")
-                    await asyncio.sleep(e.retry_after)
-                    try:
-                        sent_message = await bot.send_message(chat_id=user_id, text=text)
-                        message_id = sent_message.message_id
-                        db.update_user_status_message_id(user_id, message_id)
-                    except telegram.error.TelegramError as retry_e:
-                        logger.error(f"Повторная ошибка при отправке для user {user_id}: {retry_e}")
-                        return
                 except telegram.error.TelegramError as e:
                     logger.error(f"Не удалось отправить новое сообщение для user {user_id}: {e}")
                     return
@@ -133,5 +123,6 @@ progress_manager = ProgressManager()
 process_tracker = ProcessTracker()
 
 
-async def update_status_message(user_id: int, bot, text: str, pin: bool = True):
-    await progress_manager.update_status_message(user_id, bot, text, pin)
+async def update_status_message(user_id: int, bot, text: str, pin: bool = True, force: bool = False,
+                                reply_markup=None):
+    await progress_manager.update_status_message(user_id, bot, text, pin, force, reply_markup)
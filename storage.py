@@ -0,0 +1,312 @@
+import asyncio
+import logging
+import os
+import shutil
+import socket
+import time
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Collection, Dict, List, Optional
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+STORAGE_ROOT = os.getenv('DOWNLOAD_FOLDER', 'downloads')
+STORAGE_QUOTA_MB = int(os.getenv('STORAGE_QUOTA_MB', '10240'))
+STORAGE_MIN_FREE_MB = int(os.getenv('STORAGE_MIN_FREE_MB', '512'))
+STORAGE_WAIT_TIMEOUT = float(os.getenv('STORAGE_WAIT_TIMEOUT', '900'))
+STORAGE_SWEEP_INTERVAL = int(os.getenv('STORAGE_SWEEP_INTERVAL', '600'))
+ORPHAN_MAX_AGE = int(os.getenv('ORPHAN_MAX_AGE', '3600'))
+TMPFS_ROOT = os.getenv('TMPFS_ROOT')
+TMPFS_QUOTA_MB = int(os.getenv('TMPFS_QUOTA_MB', '512'))
+TMPFS_MAX_JOB_MB = int(os.getenv('TMPFS_MAX_JOB_MB', '64'))
+
+JOB_DIR_PREFIX = 'video_bot_'
+OWNER_FILE = '.owner'
+MIN_RESERVATION = 16 * MB
+AUDIO_SOURCE_BITRATE = 160_000
+AUDIO_OUTPUT_BITRATE = 192_000
+DEFAULT_VIDEO_BITRATE = 2_500_000
+
+
+def job_dir_name(job_id: int) -> str:
+    return f"{JOB_DIR_PREFIX}job{job_id}"
+
+
+class StorageQuotaExceeded(Exception):
+    pass
+
+
+def estimate_job_bytes(info: Optional[Dict[str, Any]], is_video: bool, by_timestamps: bool) -> int:
+    info = info or {}
+    duration = info.get('duration') or 0
+    if is_video:
+        size = info.get('filesize') or info.get('filesize_approx') or sum(
+            f.get('filesize') or f.get('filesize_approx') or 0 for f in info.get('requested_formats') or [])
+        if not size:
+            size = duration * DEFAULT_VIDEO_BITRATE / 8
+    else:
+        size = duration * (AUDIO_SOURCE_BITRATE + AUDIO_OUTPUT_BITRATE) / 8
+    if by_timestamps:
+        size *= 2
+    return max(int(size * 1.1), MIN_RESERVATION)
+
+
+def _move_dir(source: Path, target: Path):
+    shutil.rmtree(target, ignore_errors=True)
+    target.parent.mkdir(parents=True, exist_ok=True)
+    shutil.move(str(source), str(target))
+
+
+class Volume:
+    def __init__(self, root: Path, quota_bytes: int, max_job_bytes: Optional[int] = None):
+        self.root = root
+        self.quota_bytes = quota_bytes
+        self.max_job_bytes = max_job_bytes
+        self.reserved = 0
+        self.free = 0
+
+    def refresh(self) -> int:
+        try:
+            self.root.mkdir(parents=True, exist_ok=True)
+            self.free = shutil.disk_usage(self.root).free
+        except OSError:
+            self.free = 0
+        return self.free
+
+    def fits(self, size: int) -> bool:
+        if self.reserved + size > self.quota_bytes:
+            return False
+        return size <= self.free - STORAGE_MIN_FREE_MB * MB
+
+    def accepts(self, size: int) -> bool:
+        return size <= self.quota_bytes and (self.max_job_bytes is None or size <= self.max_job_bytes)
+
+
+class Reservation:
+    def __init__(self, manager: 'StorageManager', volume: Volume, path: Path, size: int,
+                 on_evict: Optional[Callable[[], Awaitable[None]]] = None):
+        self.manager = manager
+        self.volume = volume
+        self.path = path
+        self.size = size
+        self.on_evict = on_evict
+        self.released = False
+
+    async def resize(self, size: int, timeout: float = STORAGE_WAIT_TIMEOUT):
+        await self.manager.resize(self, size, timeout)
+
+    async def release(self, keep_files: bool = False):
+        await self.manager.release(self, keep_files)
+
+
+class StorageManager:
+    def __init__(self, root: str = STORAGE_ROOT, quota_mb: int = STORAGE_QUOTA_MB,
+                 tmpfs_root: Optional[str] = TMPFS_ROOT, tmpfs_quota_mb: int = TMPFS_QUOTA_MB,
+                 tmpfs_max_job_mb: int = TMPFS_MAX_JOB_MB):
+        self.disk = Volume(Path(root).resolve(), quota_mb * MB)
+        self.tmpfs = Volume(Path(tmpfs_root), tmpfs_quota_mb * MB, tmpfs_max_job_mb * MB) if tmpfs_root else None
+        self.active: Dict[Path, Reservation] = {}
+        self.waiting = 0
+        self._condition: Optional[asyncio.Condition] = None
+
+    @property
+    def volumes(self) -> List[Volume]:
+        return [v for v in (self.tmpfs, self.disk) if v is not None]
+
+    @property
+    def condition(self) -> asyncio.Condition:
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    def _refresh(self):
+        for volume in self.volumes:
+            volume.refresh()
+
+    def _existing_volume(self, name: Optional[str], size: int) -> Optional[Volume]:
+        return next((v for v in self.volumes if name and (v.root / name).is_dir() and v.accepts(size)), None)
+
+    @staticmethod
+    def _prepare_dir(path: Path):
+        path.mkdir(parents=True, exist_ok=True)
+        (path / OWNER_FILE).write_text(f"{socket.gethostname()} {os.getpid()}")
+
+    def _pick_volume(self, size: int) -> Optional[Volume]:
+        if self.tmpfs and self.tmpfs.accepts(size) and self.tmpfs.fits(size):
+            return self.tmpfs
+        if self.disk.fits(size):
+            return self.disk
+        return None
+
+    async def _evict(self, predicate: Callable[[], Any]):
+        while True:
+            async with self.condition:
+                result = predicate()
+                if result:
+                    return result
+            victim = next((r for r in self.active.values() if r.on_evict), None)
+            if not victim:
+                return None
+            on_evict, victim.on_evict = victim.on_evict, None
+            logger.info(f"Резервация {victim.path} ({victim.size / MB:.0f} МБ) освобождена ради подтверждённой задачи")
+            await on_evict()
+
+    async def _wait_for(self, predicate: Callable[[], Any], size: int, timeout: float,
+                        on_wait: Optional[Callable[[], Awaitable[None]]] = None, evict: bool = False):
+        await asyncio.get_running_loop().run_in_executor(None, self._refresh)
+        if evict:
+            result = await self._evict(predicate)
+            if result:
+                return result
+        async with self.condition:
+            result = predicate()
+            if result:
+                return result
+            logger.info(f"Недостаточно места для {size / MB:.0f} МБ, задача ожидает в очереди")
+            if on_wait:
+                await on_wait()
+            self.waiting += 1
+            try:
+                return await asyncio.wait_for(self.condition.wait_for(predicate), timeout)
+            except asyncio.TimeoutError:
+                raise StorageQuotaExceeded(
+                    f"Недостаточно места для загрузки (~{size / MB:.0f} МБ), попробуйте позже") from None
+            finally:
+                self.waiting -= 1
+
+    async def reserve(self, size: int, timeout: float = STORAGE_WAIT_TIMEOUT,
+                      on_wait: Optional[Callable[[], Awaitable[None]]] = None,
+                      name: Optional[str] = None,
+                      on_evict: Optional[Callable[[], Awaitable[None]]] = None) -> Reservation:
+        size = max(size, MIN_RESERVATION)
+        if not self.disk.accepts(size) and not (self.tmpfs and self.tmpfs.accepts(size)):
+            raise StorageQuotaExceeded(f"Файл слишком большой (~{size / MB:.0f} МБ) для хранилища")
+        if on_evict and self.waiting:
+            raise StorageQuotaExceeded("Подтверждённые задачи ожидают места в хранилище")
+
+        loop = asyncio.get_running_loop()
+        existing = await loop.run_in_executor(None, self._existing_volume, name, size)
+        if existing:
+            volume = await self._wait_for(lambda: existing if existing.fits(size) else None, size, timeout, on_wait,
+                                          evict=on_evict is None)
+        else:
+            volume = await self._wait_for(lambda: self._pick_volume(size), size, timeout, on_wait,
+                                          evict=on_evict is None)
+        volume.reserved += size
+        path = volume.root / (name or f"{JOB_DIR_PREFIX}{os.urandom(4).hex()}")
+        try:
+            await loop.run_in_executor(None, self._prepare_dir, path)
+        except BaseException:
+            volume.reserved -= size
+            raise
+        reservation = Reservation(self, volume, path, size, on_evict)
+        self.active[path] = reservation
+        logger.info(f"Зарезервировано {size / MB:.0f} МБ в {path}")
+        return reservation
+
+    async def resize(self, reservation: Reservation, size: int, timeout: float = STORAGE_WAIT_TIMEOUT):
+        size = max(size, MIN_RESERVATION)
+        delta = size - reservation.size
+        volume = reservation.volume
+        if delta > 0 and volume is self.tmpfs:
+            await asyncio.get_running_loop().run_in_executor(None, volume.refresh)
+            if not (volume.accepts(size) and volume.fits(delta)):
+                await self._move(reservation, self.disk, size, timeout)
+                return
+        if delta > 0:
+            if not volume.accepts(size):
+                raise StorageQuotaExceeded(f"Файл слишком большой (~{size / MB:.0f} МБ) для хранилища")
+            await self._wait_for(lambda: volume.fits(delta), delta, timeout, evict=reservation.on_evict is None)
+        volume.reserved += delta
+        reservation.size = size
+        if delta < 0:
+            async with self.condition:
+                self.condition.notify_all()
+
+    async def _move(self, reservation: Reservation, volume: Volume, size: int, timeout: float):
+        if not volume.accepts(size):
+            raise StorageQuotaExceeded(f"Файл слишком большой (~{size / MB:.0f} МБ) для хранилища")
+        await self._wait_for(lambda: volume.fits(size), size, timeout, evict=reservation.on_evict is None)
+        volume.reserved += size
+        path = volume.root / reservation.path.name
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, _move_dir, reservation.path, path)
+        except BaseException:
+            volume.reserved -= size
+            raise
+        logger.info(f"Каталог задачи перенесён из {reservation.path} в {path}: ожидается ~{size / MB:.0f} МБ")
+        self.active.pop(reservation.path, None)
+        previous = reservation.volume
+        previous.reserved -= reservation.size
+        reservation.volume, reservation.path, reservation.size = volume, path, size
+        self.active[path] = reservation
+        await asyncio.get_running_loop().run_in_executor(None, previous.refresh)
+        async with self.condition:
+            self.condition.notify_all()
+
+    async def release(self, reservation: Reservation, keep_files: bool = False):
+        if reservation.released:
+            return
+        reservation.released = True
+        if not keep_files:
+            await asyncio.get_running_loop().run_in_executor(None, shutil.rmtree, reservation.path, True)
+            await asyncio.get_running_loop().run_in_executor(None, reservation.volume.refresh)
+        self.active.pop(reservation.path, None)
+        reservation.volume.reserved -= reservation.size
+        async with self.condition:
+            self.condition.notify_all()
+
+    def remove_job_dir(self, name: str):
+        for volume in self.volumes:
+            path = volume.root / name
+            if path not in self.active:
+                shutil.rmtree(path, ignore_errors=True)
+
+    @staticmethod
+    def _owner_alive(path: Path) -> bool:
+        try:
+            host, pid = (path / OWNER_FILE).read_text().split()
+        except (OSError, ValueError):
+            return False
+        if host != socket.gethostname():
+            return True
+        if int(pid) == os.getpid():
+            return False
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+        return True
+
+    def sweep_orphans(self, max_age: float = ORPHAN_MAX_AGE, keep: Collection[str] = ()) -> int:
+        removed = 0
+        now = time.time()
+        for volume in self.volumes:
+            if not volume.root.exists():
+                continue
+            for path in volume.root.glob(f"{JOB_DIR_PREFIX}*"):
+                if path in self.active or path.name in keep or not path.is_dir() or self._owner_alive(path):
+                    continue
+                try:
+                    if now - path.stat().st_mtime < max_age:
+                        continue
+                    shutil.rmtree(path)
+                    removed += 1
+                except OSError as e:
+                    logger.warning(f"Не удалось удалить осиротевший каталог {path}: {e}")
+        if removed:
+            logger.info(f"Удалено осиротевших каталогов: {removed}")
+        return removed
+
+
+storage_manager = StorageManager()
+
+metrics.registry.gauge('syntube_storage_reserved_bytes', 'Зарезервированное место под задачи',
+                       lambda: sum(v.reserved for v in storage_manager.volumes))
+metrics.registry.gauge('syntube_storage_active_jobs', 'Каталоги задач с активной резервацией',
+                       lambda: len(storage_manager.active))
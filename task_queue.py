@@ -0,0 +1,152 @@
+import importlib
+import logging
+import os
+from typing import Any, Dict, List, Optional
+
+import db
+
+logger = logging.getLogger(__name__)
+
+JOB_MODE = os.getenv('JOB_MODE', 'local')
+JOB_QUEUE_BACKEND = os.getenv('JOB_QUEUE_BACKEND', 'sqlite')
+JOB_LEASE_SECONDS = float(os.getenv('JOB_LEASE_SECONDS', '60'))
+JOB_POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL', '1'))
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', '3'))
+JOB_EVENTS_TTL = float(os.getenv('JOB_EVENTS_TTL', '86400'))
+LOCAL_WORKER_ID = 'local'
+
+
+class JobQueue:
+    def enqueue(self, user_id: int, payload: Dict[str, Any]) -> int:
+        raise NotImplementedError
+
+    def claim(self, worker_id: str) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def heartbeat(self, job_id: int, worker_id: str):
+        raise NotImplementedError
+
+    def report(self, job_id: int, user_id: int, text: str):
+        raise NotImplementedError
+
+    def complete(self, job_id: int, user_id: int):
+        raise NotImplementedError
+
+    def fail(self, job_id: int, user_id: int, error: str):
+        raise NotImplementedError
+
+    def cancel(self, job_id: int, user_id: int) -> bool:
+        raise NotImplementedError
+
+    def is_cancelled(self, job_id: int) -> bool:
+        raise NotImplementedError
+
+    def expire_cancelling(self):
+        raise NotImplementedError
+
+    def cancelled(self, job_id: int, user_id: int):
+        raise NotImplementedError
+
+    def events(self, after_event_id: int) -> List[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def last_event_id(self) -> int:
+        raise NotImplementedError
+
+    def checkpoint(self, job_id: int, stage: str, data: Dict[str, Any]):
+        raise NotImplementedError
+
+    def unfinished(self, worker_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def depth(self) -> int:
+        raise NotImplementedError
+
+    def prune_events(self):
+        raise NotImplementedError
+
+
+class SQLiteJobQueue(JobQueue):
+    def __init__(self, lease_seconds: float = JOB_LEASE_SECONDS, max_attempts: int = JOB_MAX_ATTEMPTS,
+                 events_ttl: float = JOB_EVENTS_TTL):
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.events_ttl = events_ttl
+
+    def enqueue(self, user_id: int, payload: Dict[str, Any]) -> int:
+        job_id = db.create_job(user_id, payload)
+        if job_id is None:
+            raise RuntimeError("Не удалось поставить задачу в очередь")
+        return job_id
+
+    def claim(self, worker_id: str) -> Optional[Dict[str, Any]]:
+        self.expire_cancelling()
+        for job in db.fail_exhausted_jobs(self.lease_seconds, self.max_attempts, LOCAL_WORKER_ID):
+            logger.warning(f"Задача {job['job_id']} снята после {job['attempts']} неудачных попыток")
+            db.add_job_event(job['job_id'], job['user_id'], 'failed', "Задача прерывалась слишком много раз")
+        return db.claim_job(worker_id, self.lease_seconds, self.max_attempts, LOCAL_WORKER_ID)
+
+    def heartbeat(self, job_id: int, worker_id: str):
+        db.heartbeat_job(job_id, worker_id)
+
+    def report(self, job_id: int, user_id: int, text: str):
+        db.add_job_event(job_id, user_id, 'progress', text)
+
+    def complete(self, job_id: int, user_id: int):
+        db.finish_job(job_id, 'done')
+        db.add_job_event(job_id, user_id, 'done')
+
+    def fail(self, job_id: int, user_id: int, error: str):
+        db.finish_job(job_id, 'failed', error)
+        db.add_job_event(job_id, user_id, 'failed', error)
+
+    def cancel(self, job_id: int, user_id: int) -> bool:
+        status = db.cancel_job(job_id, self.lease_seconds)
+        if status == 'cancelled':
+            db.add_job_event(job_id, user_id, 'cancelled')
+        return status is not None
+
+    def is_cancelled(self, job_id: int) -> bool:
+        job = db.get_job(job_id)
+        return bool(job) and job['status'] in ('cancelling', 'cancelled')
+
+    def expire_cancelling(self):
+        for job in db.finish_stale_cancelling_jobs(self.lease_seconds):
+            logger.warning(f"Воркер задачи {job['job_id']} пропал во время отмены, задача помечена отменённой")
+            db.add_job_event(job['job_id'], job['user_id'], 'cancelled')
+
+    def cancelled(self, job_id: int, user_id: int):
+        db.finish_job(job_id, 'cancelled')
+        db.add_job_event(job_id, user_id, 'cancelled')
+
+    def events(self, after_event_id: int) -> List[Dict[str, Any]]:
+        return db.get_job_events(after_event_id)
+
+    def last_event_id(self) -> int:
+        return db.get_last_job_event_id()
+
+    def checkpoint(self, job_id: int, stage: str, data: Dict[str, Any]):
+        db.update_job_checkpoint(job_id, stage, data)
+
+    def unfinished(self, worker_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        return db.get_unfinished_jobs(worker_id)
+
+    def depth(self) -> int:
+        return db.count_jobs('queued')
+
+    def prune_events(self):
+        db.delete_old_job_events(self.events_ttl)
+
+
+local_queue = SQLiteJobQueue()
+
+
+def get_job_queue(backend: str = JOB_QUEUE_BACKEND) -> JobQueue:
+    if backend == 'sqlite':
+        return SQLiteJobQueue()
+    module_name, _, class_name = backend.partition(':')
+    if not class_name:
+        raise ValueError(f"Неверный JOB_QUEUE_BACKEND '{backend}', ожидается 'sqlite' или 'module:Class'")
+    queue_class = getattr(importlib.import_module(module_name), class_name)
+    logger.info(f"Используется очередь задач {backend}")
+    return queue_class()
@@ -1,7 +1,22 @@
+import asyncio
+import logging
+import os
 import re
 import unicodedata
+from datetime import timedelta
 from pathlib import Path
-from typing import Optional
+from typing import Awaitable, Callable, List, Optional, Tuple, TypeVar
+
+import telegram.error
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_RETRIES = int(os.getenv('TELEGRAM_RETRIES', '3'))
+TELEGRAM_RETRY_MAX_WAIT = float(os.getenv('TELEGRAM_RETRY_MAX_WAIT', '60'))
+
+T = TypeVar('T')
 
 def sanitize_filename(filename: str) -> str:
     filename = str(filename).replace("/", "-").replace("\\", "-")
@@ -15,6 +30,22 @@ def sanitize_filename(filename: str) -> str:
         filename = "downloaded_track"
     return filename[:200]
 
+def retry_after_seconds(retry_after) -> float:
+    return retry_after.total_seconds() if isinstance(retry_after, timedelta) else float(retry_after)
+
+async def call_with_retry(call: Callable[[], Awaitable[T]], method: str, retries: int = TELEGRAM_RETRIES,
+                          max_wait: float = TELEGRAM_RETRY_MAX_WAIT) -> T:
+    for attempt in range(retries + 1):
+        try:
+            return await call()
+        except telegram.error.RetryAfter as e:
+            metrics.count_retry_after(method)
+            delay = retry_after_seconds(e.retry_after)
+            if attempt == retries or delay > max_wait:
+                raise
+            logger.warning(f"FloodWait для {method}, ожидание {delay} секунд (попытка {attempt + 1} из {retries})")
+            await asyncio.sleep(delay)
+
 def format_duration(seconds: int) -> str:
     if seconds < 60:
         return f"{seconds}с"
@@ -122,4 +153,16 @@ def seconds_to_time_string(seconds: int) -> str:
     if hours > 0:
         return f"{hours}:{minutes:02d}:{secs:02d}"
     else:
-        return f"{minutes}:{secs:02d}"
\ No newline at end of file
+        return f"{minutes}:{secs:02d}"
+
+async def run_process(cmd: List[str]) -> Tuple[int, str, str]:
+    process = await asyncio.create_subprocess_exec(
+        *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    try:
+        stdout, stderr = await process.communicate()
+    except BaseException:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        raise
+    return process.returncode, stdout.decode(errors='replace'), stderr.decode(errors='replace')
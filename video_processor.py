@@ -1,33 +1,60 @@
 import os
 import re
+import shlex
+import sys
+import json
 import asyncio
-import tempfile
 import shutil
 from pathlib import Path
-from typing import List, Tuple, Optional, Dict, Any, Callable
-import yt_dlp
-from PIL import Image
-from mutagen.mp3 import MP3
-from mutagen.id3 import ID3, TIT2, TPE1, TALB, APIC
+from typing import List, Tuple, Optional, Dict, Any, Callable, AsyncIterator, Collection
 import logging
+import threading
 import unicodedata
+import bandwidth
+import keyframes
+import metrics
+import storage
+from lazy_imports import lazy_import
+from utils import run_process
+
+yt_dlp = lazy_import('yt_dlp')
+Image = lazy_import('PIL.Image')
+mutagen_mp3 = lazy_import('mutagen.mp3')
+mutagen_id3 = lazy_import('mutagen.id3')
 
 logger = logging.getLogger(__name__)
 
+INFO_FILE = 'info.json'
+STREAM_CONTAINERS = ('webm', 'ogg', 'opus', 'mp3')
+PROBE_TIMEOUT = float(os.getenv('PROBE_TIMEOUT', '1.5'))
+DOWNLOAD_CANCEL_TIMEOUT = float(os.getenv('DOWNLOAD_CANCEL_TIMEOUT', '5'))
+FRAGMENT_CONCURRENCY = int(os.getenv('FRAGMENT_CONCURRENCY', '4'))
+EXTERNAL_DOWNLOADER = os.getenv('EXTERNAL_DOWNLOADER')
+EXTERNAL_DOWNLOADER_ARGS = shlex.split(os.getenv('EXTERNAL_DOWNLOADER_ARGS', ''))
+OEMBED_ENDPOINTS = {
+    'youtube.com': 'https://www.youtube.com/oembed',
+    'youtu.be': 'https://www.youtube.com/oembed',
+    'vimeo.com': 'https://vimeo.com/api/oembed.json',
+    'soundcloud.com': 'https://soundcloud.com/oembed',
+}
+
 
 class VideoProcessor:
     def __init__(self, temp_dir: str = None):
         unique_id = os.urandom(4).hex()
-        self.temp_dir = Path(temp_dir) if temp_dir else Path(tempfile.gettempdir()) / f"video_bot_{unique_id}"
+        self.temp_dir = Path(temp_dir) if temp_dir else Path(storage.STORAGE_ROOT) / f"{storage.JOB_DIR_PREFIX}{unique_id}"
         self.video_info = None
         self.thumbnail_path = None
         self.comments = None
+        self.cancel_event = threading.Event()
         try:
             self.loop = asyncio.get_running_loop()
         except RuntimeError:
             self.loop = asyncio.new_event_loop()
             asyncio.set_event_loop(self.loop)
-        self.temp_dir.mkdir(exist_ok=True, parents=True)
+
+    async def prepare_temp_dir(self):
+        await self.loop.run_in_executor(None, lambda: self.temp_dir.mkdir(exist_ok=True, parents=True))
 
     def create_progress_bar(self, percentage: int, length: int = 10) -> str:
         percentage = max(0, min(100, percentage))
@@ -55,16 +82,95 @@ class VideoProcessor:
 
         return text if text else "Unknown"
 
-    async def get_video_info(self, video_url: str) -> Dict[str, Any]:
-        ydl_opts = {'quiet': True, 'no_warnings': True, 'extractflat': 'discard_in_playlist'}
+    @property
+    def info_file(self) -> Path:
+        return self.temp_dir / INFO_FILE
+
+    async def get_video_info(self, video_url: str, cache: bool = False) -> Dict[str, Any]:
+        if cache and await self.loop.run_in_executor(None, self.info_file.exists):
+            self.video_info = await self.loop.run_in_executor(None, lambda: json.loads(self.info_file.read_text()))
+            logger.info(f"Информация о видео загружена из {self.info_file}")
+            return self.video_info
+
+        ydl_opts = {'quiet': True, 'no_warnings': True, 'extract_flat': 'in_playlist'}
         try:
             with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                info = await self.loop.run_in_executor(None, lambda: ydl.extract_info(video_url, download=False))
+                info = await self.loop.run_in_executor(metrics.download_executor,
+                                                       lambda: ydl.extract_info(video_url, download=False))
                 self.video_info = info
+                if cache:
+                    info_json = json.dumps(ydl.sanitize_info(info), ensure_ascii=False)
+                    await self.loop.run_in_executor(None, self.info_file.write_text, info_json)
                 return info
         except Exception as e:
             raise Exception(f"Ошибка получения информации о видео: {str(e)}") from e
 
+    def _blocking_oembed(self, video_url: str) -> Optional[Dict[str, Any]]:
+        import requests
+        from urllib.parse import urlparse, parse_qs
+
+        parsed = urlparse(video_url)
+        host = (parsed.hostname or '').lower().removeprefix('www.').removeprefix('m.').removeprefix('music.')
+        endpoint = OEMBED_ENDPOINTS.get(host)
+        if not endpoint or 'list' in parse_qs(parsed.query) or parsed.path.startswith(('/playlist', '/sets')):
+            return None
+        response = requests.get(endpoint, params={'url': video_url, 'format': 'json'}, timeout=PROBE_TIMEOUT)
+        response.raise_for_status()
+        data = response.json()
+        if not data.get('title'):
+            return None
+        return {'title': data['title'], 'duration': data.get('duration'), 'uploader': data.get('author_name'),
+                'webpage_url': video_url, '_type': 'video'}
+
+    def _blocking_flat_probe(self, video_url: str) -> Optional[Dict[str, Any]]:
+        ydl_opts = {'quiet': True, 'no_warnings': True, 'extract_flat': True, 'lazy_playlist': True,
+                    'socket_timeout': PROBE_TIMEOUT}
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            info = ydl.extract_info(video_url, download=False, process=False)
+            if info and info.get('_type') == 'url' and info.get('url'):
+                info = ydl.extract_info(info['url'], download=False, process=False)
+        if not info or not info.get('title') or info.get('_type') in ('url', 'url_transparent'):
+            return None
+        playlist_count = info.get('playlist_count')
+        return {'title': info['title'], 'duration': info.get('duration'), 'uploader': info.get('uploader'),
+                'webpage_url': info.get('webpage_url') or video_url, '_type': info.get('_type', 'video'),
+                'playlist_count': playlist_count if isinstance(playlist_count, int) else None}
+
+    async def probe_link(self, video_url: str) -> Dict[str, Any]:
+        for method, probe in (('oembed', self._blocking_oembed), ('flat', self._blocking_flat_probe)):
+            try:
+                with metrics.span('probe', method=method):
+                    info = await self.loop.run_in_executor(metrics.download_executor, probe, video_url)
+            except Exception as e:
+                logger.info(f"Быстрая проверка ссылки ({method}) не удалась: {e}")
+                continue
+            if info:
+                logger.info(f"Ссылка {video_url} проверена методом {method}")
+                return info
+
+        with metrics.span('probe', method='full'):
+            return await self.get_video_info(video_url)
+
+    async def iter_playlist_entries(self, playlist_url: str) -> AsyncIterator[Dict[str, Any]]:
+        ydl_opts = {'quiet': True, 'no_warnings': True, 'extract_flat': 'in_playlist', 'lazy_playlist': True}
+        try:
+            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                info = await self.loop.run_in_executor(
+                    metrics.download_executor, lambda: ydl.extract_info(playlist_url, download=False, process=False))
+                self.video_info = info
+                entries = iter(info.get('entries') or [])
+                while True:
+                    entry = await self.loop.run_in_executor(metrics.download_executor, next, entries, None)
+                    if entry is None:
+                        break
+                    yield entry
+        except Exception as e:
+            raise Exception(f"Ошибка получения элементов плейлиста: {str(e)}") from e
+
+    @staticmethod
+    def is_playlist(info: Optional[Dict[str, Any]]) -> bool:
+        return bool(info) and info.get('_type') == 'playlist'
+
     async def get_video_comments(self, video_url: str, max_comments: int = 50) -> List[Dict]:
         ydl_opts = {
             'quiet': True,
@@ -77,7 +183,8 @@ class VideoProcessor:
 
         try:
             with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                info = await self.loop.run_in_executor(None, lambda: ydl.extract_info(video_url, download=False))
+                info = await self.loop.run_in_executor(metrics.download_executor,
+                                                       lambda: ydl.extract_info(video_url, download=False))
                 self.comments = info.get('comments', []) or []
                 logger.info(f"Получено {len(self.comments)} комментариев")
                 return self.comments
@@ -229,6 +336,7 @@ class VideoProcessor:
 
     def _blocking_download_thumbnail(self, best_thumbnail):
         import requests
+        self.temp_dir.mkdir(exist_ok=True, parents=True)
         response = requests.get(best_thumbnail['url'], stream=True, timeout=30)
         response.raise_for_status()
         file_ext, content_type = '.jpg', response.headers.get('content-type')
@@ -250,21 +358,115 @@ class VideoProcessor:
             thumbnails = self.video_info.get('thumbnails', [])
             if not thumbnails: return None
             thumbnails.sort(key=lambda x: x.get('width', 0) * x.get('height', 0), reverse=True)
-            return await self.loop.run_in_executor(None, self._blocking_download_thumbnail, thumbnails[0])
+            return await self.loop.run_in_executor(metrics.download_executor, self._blocking_download_thumbnail,
+                                                   thumbnails[0])
         except Exception as e:
             logger.warning(f"Ошибка загрузки обложки: {e}")
             return None
 
+    async def download_audio_streaming(self, video_url: str,
+                                       progress_callback: Optional[Callable[[float], None]] = None,
+                                       share: Optional[bandwidth.DownloadShare] = None) -> Path:
+        formats = self.video_info.get('formats')
+        if formats is not None and not any(f.get('ext') in STREAM_CONTAINERS and f.get('acodec') not in (None, 'none')
+                                           for f in formats):
+            raise RuntimeError("нет аудиоформата, который можно декодировать из потока")
+        safe_title = self.sanitize_filename(self.video_info['title'])
+        output_file = self.temp_dir / f"{safe_title}.mp3"
+
+        ytdlp_cmd = [
+            sys.executable, '-m', 'yt_dlp', '--quiet', '--no-warnings', '--no-part',
+            '--progress', '--newline', '--progress-template', 'download:%(progress._percent_str)s',
+            '-f', '/'.join(f'bestaudio[ext={ext}]' for ext in STREAM_CONTAINERS),
+            '-N', str(FRAGMENT_CONCURRENCY),
+            '-o', '-', video_url
+        ]
+        if share and share.rate:
+            ytdlp_cmd[-3:-3] = ['--limit-rate', str(int(share.rate))]
+        ffmpeg_cmd = [
+            'ffmpeg', '-hide_banner', '-loglevel', 'error',
+            '-i', 'pipe:0',
+            '-vn', '-c:a', 'libmp3lame', '-b:a', '192k',
+            '-y', str(output_file)
+        ]
+
+        read_fd, write_fd = os.pipe()
+        try:
+            downloader = await asyncio.create_subprocess_exec(
+                *ytdlp_cmd, stdout=write_fd, stderr=asyncio.subprocess.PIPE)
+            encoder = await asyncio.create_subprocess_exec(
+                *ffmpeg_cmd, stdin=read_fd, stderr=asyncio.subprocess.PIPE)
+        finally:
+            os.close(read_fd)
+            os.close(write_fd)
+
+        async def read_progress():
+            errors = []
+            async for raw_line in downloader.stderr:
+                line = raw_line.decode(errors='replace').strip()
+                percent_str = line.replace('%', '').strip()
+                try:
+                    percent = float(percent_str)
+                except ValueError:
+                    if line:
+                        errors.append(line)
+                    continue
+                if progress_callback:
+                    await progress_callback(percent)
+            return errors
+
+        try:
+            download_errors, (_, encode_errors), _ = await asyncio.gather(
+                read_progress(), encoder.communicate(), downloader.wait())
+        except BaseException:
+            for process in (downloader, encoder):
+                if process.returncode is None:
+                    process.kill()
+                    await process.wait()
+            raise
+
+        if downloader.returncode != 0 or encoder.returncode != 0 or not output_file.exists():
+            output_file.unlink(missing_ok=True)
+            details = '; '.join(download_errors[-3:]) or encode_errors.decode(errors='replace').strip()[-300:]
+            raise RuntimeError(f"Потоковая загрузка не удалась (yt-dlp={downloader.returncode}, "
+                               f"ffmpeg={encoder.returncode}): {details}")
+        return output_file
+
     async def download_media(self, video_url: str, is_video: bool = True,
-                             progress_callback: Optional[Callable[[float], None]] = None) -> Path:
+                             progress_callback: Optional[Callable[[float], None]] = None,
+                             stream_transcode: bool = False) -> Path:
+        await self.prepare_temp_dir()
+        with bandwidth.governor.share() as share:
+            if not is_video and stream_transcode:
+                try:
+                    return await self.download_audio_streaming(video_url, progress_callback, share)
+                except Exception as e:
+                    logger.warning(f"Потоковое перекодирование недоступно, обычная загрузка: {e}")
+            return await self._download_ytdlp(video_url, is_video, progress_callback, share)
+
+    async def _download_ytdlp(self, video_url: str, is_video: bool,
+                              progress_callback: Optional[Callable[[float], None]],
+                              share: bandwidth.DownloadShare) -> Path:
+        last_percent = None
+
         def progress_hook(d):
-            if d['status'] == 'downloading' and progress_callback:
+            nonlocal last_percent
+            if self.cancel_event.is_set():
+                raise yt_dlp.utils.DownloadCancelled('Загрузка отменена')
+            if d['status'] != 'downloading':
+                return
+            delay = share.throttle(d.get('filename'), d.get('downloaded_bytes'))
+            if delay and self.cancel_event.wait(delay):
+                raise yt_dlp.utils.DownloadCancelled('Загрузка отменена')
+            if progress_callback:
                 percent_str = d.get('_percent_str', '0%').strip().replace('%', '')
                 try:
                     percent = float(percent_str)
-                    asyncio.run_coroutine_threadsafe(progress_callback(percent), self.loop)
                 except (ValueError, TypeError):
-                    pass
+                    return
+                if int(percent) != last_percent:
+                    last_percent = int(percent)
+                    asyncio.run_coroutine_threadsafe(progress_callback(percent), self.loop)
 
         format_selector = 'best[ext=mp4]/bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best' if is_video else 'bestaudio[ext=m4a]/bestaudio/best'
         safe_title = self.sanitize_filename(self.video_info['title'])
@@ -275,15 +477,35 @@ class VideoProcessor:
             'outtmpl': str(output_template),
             'quiet': True,
             'no_warnings': True,
+            'continuedl': True,
+            'concurrent_fragment_downloads': FRAGMENT_CONCURRENCY,
             'progress_hooks': [progress_hook]
         }
+        if EXTERNAL_DOWNLOADER:
+            ydl_opts['external_downloader'] = {'default': EXTERNAL_DOWNLOADER}
+            ydl_opts['external_downloader_args'] = {'default': EXTERNAL_DOWNLOADER_ARGS}
+            if share.rate:
+                ydl_opts['ratelimit'] = int(share.rate)
 
         if not is_video:
             ydl_opts['postprocessors'] = [
                 {'key': 'FFmpegExtractAudio', 'preferredcodec': 'mp3', 'preferredquality': '192'}]
 
-        await self.loop.run_in_executor(None, lambda: yt_dlp.YoutubeDL(ydl_opts).download([video_url]))
+        download = self.loop.run_in_executor(metrics.download_executor,
+                                             lambda: yt_dlp.YoutubeDL(ydl_opts).download([video_url]))
+        try:
+            await asyncio.shield(download)
+        except asyncio.CancelledError:
+            self.cancel_event.set()
+            try:
+                await asyncio.wait_for(download, DOWNLOAD_CANCEL_TIMEOUT)
+            except Exception:
+                pass
+            raise
+
+        return await self.loop.run_in_executor(None, self._blocking_find_download, safe_title, is_video)
 
+    def _blocking_find_download(self, safe_title: str, is_video: bool) -> Path:
         ext = 'mp4' if is_video else 'mp3'
         expected_file = self.temp_dir / f"{safe_title}.{ext}"
         if expected_file.exists(): return expected_file
@@ -301,23 +523,23 @@ class VideoProcessor:
 
             logger.info(f"Добавление метаданных в {file_path.name}: title='{title}', artist='{artist}'")
 
-            audio = MP3(str(file_path))
+            audio = mutagen_mp3.MP3(str(file_path))
 
             if audio.tags is None:
                 audio.add_tags()
                 logger.info(f"Добавлены новые теги для {file_path.name}")
 
             audio.tags.delall('TIT2')
-            audio.tags.add(TIT2(encoding=3, text=title))
+            audio.tags.add(mutagen_id3.TIT2(encoding=3, text=title))
 
             audio.tags.delall('TPE1')
-            audio.tags.add(TPE1(encoding=3, text=artist))
+            audio.tags.add(mutagen_id3.TPE1(encoding=3, text=artist))
 
             audio.tags.delall('APIC')
             if self.thumbnail_path and self.thumbnail_path.exists():
                 try:
                     with open(self.thumbnail_path, 'rb') as art:
-                        audio.tags.add(APIC(encoding=3, mime='image/jpeg', type=3, desc='Cover', data=art.read()))
+                        audio.tags.add(mutagen_id3.APIC(encoding=3, mime='image/jpeg', type=3, desc='Cover', data=art.read()))
                 except Exception as thumb_e:
                     logger.warning(f"Ошибка добавления обложки в {file_path.name}: {thumb_e}")
 
@@ -331,13 +553,26 @@ class VideoProcessor:
     async def add_metadata_to_audio(self, file_path: Path, title: str, artist: str):
         await self.loop.run_in_executor(None, self._blocking_add_metadata, file_path, title, artist)
 
-    async def split_media_ffmpeg(self, file_path: Path, timestamps: List[Tuple[int, str]], is_video: bool,
-                                 progress_callback: Optional[Callable[[int], None]] = None) -> List[Path]:
-        segments = []
+    async def iter_split_media(self, file_path: Path, timestamps: List[Tuple[int, str]], is_video: bool,
+                               progress_callback: Optional[Callable[[int], None]] = None) -> AsyncIterator[Path]:
+        async for _, segment_path in self.iter_split_segments(file_path, timestamps, is_video, progress_callback):
+            yield segment_path
+
+    async def iter_split_segments(self, file_path: Path, timestamps: List[Tuple[int, str]], is_video: bool,
+                                  progress_callback: Optional[Callable[[int], None]] = None,
+                                  skip: Collection[int] = ()) -> AsyncIterator[Tuple[int, Path]]:
+        await self.prepare_temp_dir()
         total_duration = self.video_info.get('duration')
+        video_title = self.video_info.get('title', 'Unknown Album')
         file_extension = file_path.suffix
+        keyframe_index = None
+        if is_video and (keyframes.KEYFRAME_SNAP or keyframes.SMART_CUT):
+            with metrics.span('keyframes'):
+                keyframe_index = await keyframes.get_keyframe_index(file_path, self.video_info)
 
         for i, (start_time, title) in enumerate(timestamps):
+            if i + 1 in skip:
+                continue
             end_time = timestamps[i + 1][0] if i + 1 < len(timestamps) else total_duration
 
             if end_time is None:
@@ -357,11 +592,30 @@ class VideoProcessor:
                 str(segment_path)
             ]
 
-            process = await asyncio.create_subprocess_exec(*ffmpeg_cmd)
-            await process.communicate()
-
-            if process.returncode == 0:
-                segments.append(segment_path)
+            with metrics.span('split', index=i + 1) as split_span:
+                returncode = None
+                if keyframe_index and keyframes.SMART_CUT:
+                    split_span.set(mode='smart_cut')
+                    returncode = await keyframes.smart_cut(file_path, start_time, end_time, segment_path, keyframe_index)
+                    if returncode:
+                        logger.warning(f"Точная нарезка сегмента {i + 1} не удалась, режу по ключевым кадрам")
+                if returncode != 0 and keyframe_index:
+                    split_span.set(mode='snap')
+                    start, end = keyframes.snap_range(keyframe_index, start_time, end_time, i + 1 == len(timestamps))
+                    returncode = await keyframes.copy_cut(file_path, start, end, segment_path)
+                if returncode is None:
+                    returncode, _, _ = await run_process(ffmpeg_cmd)
+                if returncode == 0:
+                    split_span.add_bytes((await self.loop.run_in_executor(None, segment_path.stat)).st_size)
+
+            if returncode == 0:
+                if not is_video:
+                    try:
+                        with metrics.span('tag', index=i + 1):
+                            await self.add_metadata_to_audio(file_path=segment_path, title=title, artist=video_title)
+                    except Exception as metadata_e:
+                        logger.error(f"Ошибка добавления метаданных для сегмента {segment_path.name}: {metadata_e}")
+                yield i + 1, segment_path
             else:
                 logger.error(f"Ошибка FFMPEG при создании сегмента '{segment_path.name}'.")
 
@@ -369,20 +623,9 @@ class VideoProcessor:
                 progress_percent = int((i + 1) / len(timestamps) * 100)
                 await progress_callback(progress_percent)
 
-        if not is_video:
-            video_title = self.video_info.get('title', 'Unknown Album')
-            for i, segment_path in enumerate(segments):
-                try:
-                    track_title = timestamps[i][1] if i < len(timestamps) else f"Track {i + 1}"
-                    await self.add_metadata_to_audio(
-                        file_path=segment_path,
-                        title=track_title,
-                        artist=video_title
-                    )
-                except Exception as metadata_e:
-                    logger.error(f"Ошибка добавления метаданных для сегмента {segment_path.name}: {metadata_e}")
-
-        return segments
+    async def split_media_ffmpeg(self, file_path: Path, timestamps: List[Tuple[int, str]], is_video: bool,
+                                 progress_callback: Optional[Callable[[int], None]] = None) -> List[Path]:
+        return [segment async for segment in self.iter_split_media(file_path, timestamps, is_video, progress_callback)]
 
     async def split_media(self, file_path: Path, timestamps: List[Tuple[int, str]], is_video: bool = True,
                           progress_callback: Optional[Callable[[int], None]] = None) -> List[Path]:
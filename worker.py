@@ -0,0 +1,168 @@
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+
+from dotenv import load_dotenv
+from telegram import Bot
+
+import bandwidth
+import db
+import loop_monitor
+import metrics
+import pipeline
+import storage
+import task_queue
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+BOT_TOKEN = os.getenv('BOT_TOKEN')
+WORKER_PROCESSES = int(os.getenv('WORKER_PROCESSES', '2'))
+JOB_EVENTS_PRUNE_INTERVAL = float(os.getenv('JOB_EVENTS_PRUNE_INTERVAL', '3600'))
+
+
+class Worker:
+    def __init__(self, worker_id: str, queue: task_queue.JobQueue, bot: Bot):
+        self.worker_id = worker_id
+        self.queue = queue
+        self.bot = bot
+        self.loop = asyncio.get_running_loop()
+        self.lease_seconds = getattr(queue, 'lease_seconds', task_queue.JOB_LEASE_SECONDS)
+        self.stopping = False
+
+    async def _call(self, func, *args):
+        return await self.loop.run_in_executor(None, func, *args)
+
+    async def _heartbeat(self, job_id: int):
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            await self._call(self.queue.heartbeat, job_id, self.worker_id)
+
+    async def _watch_cancel(self, job_id: int, checkpoint: pipeline.JobCheckpoint, task: asyncio.Task):
+        while not await self._call(self.queue.is_cancelled, job_id):
+            await asyncio.sleep(task_queue.JOB_POLL_INTERVAL)
+        logger.info(f"Задача {job_id} отменена пользователем")
+        checkpoint.cancelled = True
+        task.cancel()
+
+    async def process(self, job: dict):
+        job_id = job['job_id']
+        user_id = job['user_id']
+        last_text = None
+
+        async def report(text: str):
+            nonlocal last_text
+            if text != last_text:
+                last_text = text
+                await self._call(self.queue.report, job_id, user_id, text)
+
+        logger.info(f"Воркер {self.worker_id} взял задачу {job_id} (user {user_id})")
+        checkpoint = pipeline.JobCheckpoint.from_job(job, self.queue)
+        heartbeat = asyncio.create_task(self._heartbeat(job_id))
+        run = asyncio.create_task(pipeline.run_job(job['payload'], self.bot, report, checkpoint))
+        watcher = asyncio.create_task(self._watch_cancel(job_id, checkpoint, run))
+        try:
+            await run
+            await self._call(self.queue.complete, job_id, user_id)
+        except asyncio.CancelledError:
+            if not checkpoint.cancelled:
+                raise
+            await self._call(self.queue.cancelled, job_id, user_id)
+        except Exception as e:
+            logger.error(f"Ошибка в задаче {job_id}: {e}", exc_info=True)
+            await self._call(self.queue.fail, job_id, user_id, str(e)[:100])
+        finally:
+            for task in (heartbeat, watcher, run):
+                task.cancel()
+            await asyncio.gather(heartbeat, watcher, run, return_exceptions=True)
+
+    async def run(self):
+        pruned_at = 0.0
+        swept_at = self.loop.time()
+        while not self.stopping:
+            if self.loop.time() - pruned_at > JOB_EVENTS_PRUNE_INTERVAL:
+                pruned_at = self.loop.time()
+                await self._call(self.queue.prune_events)
+            if self.loop.time() - swept_at > storage.STORAGE_SWEEP_INTERVAL:
+                swept_at = self.loop.time()
+                await self._call(pipeline.sweep_job_dirs, storage.ORPHAN_MAX_AGE, self.queue)
+            job = await self._call(self.queue.claim, self.worker_id)
+            if not job:
+                await asyncio.sleep(task_queue.JOB_POLL_INTERVAL)
+                continue
+            await self.process(job)
+
+
+async def run_worker(index: int, processes: int):
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(metrics.executor)
+    storage.storage_manager = storage.StorageManager(quota_mb=max(1, storage.STORAGE_QUOTA_MB // processes))
+    bandwidth.governor = bandwidth.BandwidthGovernor(rate_mb=bandwidth.DOWNLOAD_RATE_LIMIT_MB / processes)
+    await loop.run_in_executor(None, db.initialize_db)
+    if loop_monitor.LOOP_MONITOR:
+        loop_monitor.monitor.start()
+
+    metrics_server = None
+    if metrics.METRICS_PORT:
+        metrics_server = metrics.MetricsServer(port=metrics.METRICS_PORT + 1 + index)
+        await metrics_server.start()
+
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    async with Bot(BOT_TOKEN) as bot:
+        worker = Worker(worker_id, task_queue.get_job_queue(), bot)
+        await loop.run_in_executor(None, pipeline.sweep_job_dirs, 0, worker.queue)
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, lambda: setattr(worker, 'stopping', True))
+        logger.info(f"Воркер {worker_id} запущен")
+        try:
+            await worker.run()
+        finally:
+            if metrics_server:
+                await metrics_server.stop()
+            await loop_monitor.monitor.stop()
+    logger.info(f"Воркер {worker_id} остановлен")
+
+
+def worker_process(index: int, processes: int):
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s [%(levelname)s] [worker %(process)d] - %(message)s (%(filename)s:%(lineno)d)',
+        level=logging.INFO
+    )
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    asyncio.run(run_worker(index, processes))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Медиа-воркеры: берут задачи из очереди и выполняют их")
+    parser.add_argument('--processes', type=int, default=WORKER_PROCESSES)
+    args = parser.parse_args()
+
+    if not BOT_TOKEN:
+        logging.basicConfig(level=logging.INFO)
+        logger.critical("BOT_TOKEN не найден в .env файле!")
+        return
+
+    if args.processes == 1:
+        worker_process(0, 1)
+        return
+
+    processes = [multiprocessing.Process(target=worker_process, args=(i, args.processes), daemon=False)
+                 for i in range(args.processes)]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+            process.join()
+
+
+if __name__ == "__main__":
+    main()